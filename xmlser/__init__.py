@@ -12,51 +12,275 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-def write_document(tree, stream=None, encoding=None):
-    """
-    If a stream is given, the result is encoded (encoding defaults to
-    sys.getfilesystemencoding) and written to the stream.
+__version__ = '0.1'
 
-    If no stream is given, the result is returned, either as a unicode
-    string or encoded using the requested encoding.
+def lazy(func, *args, **kwargs):
     """
-    from . import utils, ast
+    Wraps a value to be computed by func(*args, **kwargs) only if a template
+    reaches it, and then once; see ast.Lazy.
+    """
+    from . import ast
+    return ast.Lazy(func, args, kwargs)
+
+def _open_stream(stream, encoding, compress=None, level=6, digest=None):
+    from . import utils
     import sys
 
+    if (compress is not None or digest is not None) and stream is None and encoding is None:
+        # compressed and digested output is always bytes
+        encoding = 'utf-8'
+
     if stream is None and encoding is None:
-        _stream = utils.ListStream()
+        return utils.ListStream(), encoding
     elif stream is None:
         try:
             from cStringIO import StringIO as sio
         except ImportError:
             from StringIO import StringIO as sio
-        _stream = utils.StreamWriteEncoder(sio(), encoding)
+        target = sio()
     else:
         if encoding is None:
             encoding = sys.getfilesystemencoding()
-        _stream = utils.StreamWriteEncoder(stream, encoding)
+        target = stream
+    if digest is not None:
+        target = utils.DigestStream(target, digest)
+    if compress is not None:
+        target = utils.CompressStream(target, compress, level)
+    return utils.BufferedStreamEncoder(target, encoding), encoding
 
-    if encoding is not None and isinstance(tree, ast.Document):
+def _declare(_stream, encoding, declaration):
+    """Writes the XML declaration if it was asked for and the output is encoded"""
+    if declaration and encoding is not None:
         _stream.write('<?xml version="1.0" encoding="%s"?>' % encoding)
-    tree.write_xml(_stream)
 
+def _close_stream(_stream, stream):
+    from . import utils
+
+    _stream.flush()
+    if isinstance(getattr(_stream, 'stream', None), utils.CompressStream):
+        _stream.stream.finish()
     if stream is None:
         res = _stream.getvalue()
         _stream.close()
         return res
 
-def serialize(fmt, obj, stream=None, encoding=None):
-    if not hasattr(fmt, 'compile'):
-        from . import compiler
-        fmt = compiler.Compiler(fmt)
-    builder = fmt.compile()
-    return write_document(builder(obj), stream, encoding)
+def write_document(tree, stream=None, encoding=None, compress=None, level=6, digest=None, declaration=False):
+    """
+    If a stream is given, the result is encoded (encoding defaults to
+    sys.getfilesystemencoding) and written to the stream. Output is
+    buffered and encoded in blocks; the stream is flushed before returning.
+
+    If no stream is given, the result is returned, either as a unicode
+    string or encoded using the requested encoding.
 
-def make_serializer(fmt):
-    from . import compiler
+    With declaration set, encoded output of a single root element starts with
+    the XML declaration. It is off by default in this and all other output
+    functions, so that they all write the same bytes for the same document.
+
+    With compress set to 'gzip', 'zlib' or 'deflate', the encoded output is
+    compressed at the given level as it is written. If a hashlib digest is
+    given, it is updated with the output bytes as they are written, after
+    compression, e.g. to compute an ETag. Compressed or digested output
+    that is returned is encoded as utf-8 unless another encoding is given.
+    """
+    from . import ast
+
+    _stream, encoding = _open_stream(stream, encoding, compress, level, digest)
+    _declare(_stream, encoding, declaration and isinstance(tree, ast.Element))
+    tree.write_xml(_stream)
+    return _close_stream(_stream, stream)
+
+def _emitter(builder, _stream, encoding, iterate=False):
+    """
+    Returns the emit or iter_emit function to run and the writer to run it
+    against, using pre-encoded markup where the builder and encoding allow.
+    """
+    import codecs
+    from . import utils, writer
+
+    if encoding is not None and hasattr(builder, 'encoded') \
+            and codecs.lookup(encoding).name in utils.native_encodings:
+        emit, iter_emit = builder.encoded(encoding)
+        out = writer.EncodedWriter(_stream, encoding)
+    else:
+        emit, iter_emit = builder.emit, builder.iter_emit
+        out = writer.ElementWriter(_stream)
+    return (iter_emit if iterate else emit), out
+
+def emit_document(builder, obj, stream=None, encoding=None, compress=None, level=6, digest=None,
+                  declaration=False):
+    """
+    Like write_document, but runs the builder directly against the output
+    instead of building an element tree first. Stream, encoding,
+    compression, digest and declaration are handled as in write_document.
+    """
+    _stream, encoding = _open_stream(stream, encoding, compress, level, digest)
+    _declare(_stream, encoding, declaration and builder.single_root)
+    emit, out = _emitter(builder, _stream, encoding)
+    emit(obj, out)
+    return _close_stream(_stream, stream)
+
+def emit_documents(builder, objs, stream=None, encoding=None, root=None, compress=None, level=6, digest=None,
+                   declaration=False):
+    """
+    Like emit_document, but emits the builder for each of objs into the same
+    output, inside a root element of the given name if one is given. The XML
+    declaration is only written for a root element.
+    """
+    from . import ast
+
+    _stream, encoding = _open_stream(stream, encoding, compress, level, digest)
+    _declare(_stream, encoding, declaration and root is not None)
+    emit, out = _emitter(builder, _stream, encoding)
+    if root is not None:
+        out.start(ast.check_tag(root))
+    for obj in objs:
+        emit(obj, out)
+    if root is not None:
+        out.end()
+    return _close_stream(_stream, stream)
+
+def iter_document(builder, obj, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+                  declaration=False):
+    """
+    Generate the encoded output of the builder for obj in chunks of roughly
+    chunk_size bytes. Repetition sources are only advanced as far as needed
+    to fill the next chunk. Output is compressed, digested and declared as
+    in write_document; the chunk size applies to the compressed data.
+    """
+    from . import utils
+
+    chunks = utils.ChunkStream()
+    target = chunks
+    if digest is not None:
+        target = utils.DigestStream(target, digest)
+    if compress is not None:
+        target = utils.CompressStream(target, compress, level)
+    _stream = utils.BufferedStreamEncoder(target, encoding, chunk_size)
+    _declare(_stream, encoding, declaration and builder.single_root)
+    iter_emit, out = _emitter(builder, _stream, encoding, iterate=True)
+    for _ in iter_emit(obj, out):
+        if chunks.size >= chunk_size:
+            yield chunks.take()
+    _stream.flush()
+    if compress is not None:
+        target.finish()
+    if chunks.size:
+        yield chunks.take()
+
+def write_chunks(builder, obj, sink, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+                 declaration=False):
+    """
+    Generator writing the output of iter_document to sink chunk by chunk, for
+    use from cooperative schedulers. After each chunk it yields the result of
+    sink.drain() if the sink has a drain method, or None otherwise, so that
+    the caller can wait for the sink to catch up before resuming.
+    """
+    drain = getattr(sink, 'drain', None)
+    for chunk in iter_document(builder, obj, encoding, chunk_size, compress, level, digest, declaration):
+        sink.write(chunk)
+        yield drain() if drain is not None else None
+
+def measure_document(builder, obj, encoding='utf-8', compress=None, level=6, declaration=False):
+    """
+    Runs the builder for obj as emit_document would, but only counts the
+    output instead of keeping it. Returns a dict with the size of the output
+    in bytes and the number of elements, attributes and pieces of text.
+    """
+    from . import utils, writer
+
+    sink = utils.CountStream()
+    target = sink
+    if compress is not None:
+        target = utils.CompressStream(sink, compress, level)
+    _stream = utils.BufferedStreamEncoder(target, encoding)
+    _declare(_stream, encoding, declaration and builder.single_root)
+    emit, out = _emitter(builder, _stream, encoding)
+    counter = writer.CountingWriter(out)
+    emit(obj, counter)
+    _stream.flush()
+    if compress is not None:
+        target.finish()
+    return dict(size=sink.size, elements=counter.elements,
+                attributes=counter.attributes, texts=counter.texts)
+
+def _compile(fmt, **options):
     if not hasattr(fmt, 'compile'):
-        fmt = compiler.Compiler(fmt)
-    builder = fmt.compile()
-    def serialize(obj, stream=None, encoding=None):
-        return write_document(builder(obj), stream, encoding)
+        from . import cache
+        return cache.templates.get(fmt, **options)
+    return fmt.compile(**options)
+
+def iter_serialize(fmt, obj, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+                   declaration=False, **options):
+    builder = _compile(fmt, **options)
+    return iter_document(builder, obj, encoding, chunk_size, compress, level, digest, declaration)
+
+def iter_write(fmt, obj, sink, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+               declaration=False, **options):
+    builder = _compile(fmt, **options)
+    return write_chunks(builder, obj, sink, encoding, chunk_size, compress, level, digest, declaration)
+
+def serialize(fmt, obj, stream=None, encoding=None, direct=False, compress=None, level=6, digest=None,
+              declaration=False, **options):
+    builder = _compile(fmt, **options)
+    if direct:
+        return emit_document(builder, obj, stream, encoding, compress, level, digest, declaration)
+    return write_document(builder(obj), stream, encoding, compress, level, digest, declaration)
+
+def measure(fmt, obj, encoding='utf-8', compress=None, level=6, declaration=False, **options):
+    builder = _compile(fmt, **options)
+    return measure_document(builder, obj, encoding, compress, level, declaration)
+
+def serialize_many(fmt, objs, stream=None, encoding=None, root=None, compress=None, level=6, digest=None,
+                   declaration=False, **options):
+    builder = _compile(fmt, **options)
+    return emit_documents(builder, objs, stream, encoding, root, compress, level, digest, declaration)
+
+def write_shards(fmt, obj, factory, max_bytes=None, max_items=None, encoding='utf-8', declaration=False,
+                 **options):
+    """
+    Splits the output into standalone documents of at most max_bytes bytes
+    and max_items items of the outermost repetition, each written to a new
+    stream from factory(number). See shard.ShardWriter.
+    """
+    from . import shard
+    return shard.ShardWriter(fmt, max_bytes, max_items, encoding, declaration=declaration,
+                             **options).write(obj, factory)
+
+def make_serializer(fmt, direct=False, workers=None, batch_size=1000, **options):
+    """
+    Returns a function serializing objects with the given format. Any further
+    options are passed on to Compiler.compile.
+
+    With workers, the outermost repetitions of elements are rendered in
+    batches of batch_size items by a pool of that many processes. The pool
+    is stopped by the close attribute of the returned function.
+    """
+    if workers:
+        from . import parallel
+        builder = parallel.ParallelRenderer(fmt, workers, batch_size, **options)
+    else:
+        builder = _compile(fmt, **options)
+    if direct:
+        def serialize(obj, stream=None, encoding=None, compress=None, level=6, digest=None, declaration=False):
+            return emit_document(builder, obj, stream, encoding, compress, level, digest, declaration)
+    else:
+        def serialize(obj, stream=None, encoding=None, compress=None, level=6, digest=None, declaration=False):
+            return write_document(builder(obj), stream, encoding, compress, level, digest, declaration)
+    def iter_chunks(obj, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+                    declaration=False):
+        return iter_document(builder, obj, encoding, chunk_size, compress, level, digest, declaration)
+    def write_to(obj, sink, encoding='utf-8', chunk_size=8192, compress=None, level=6, digest=None,
+                 declaration=False):
+        return write_chunks(builder, obj, sink, encoding, chunk_size, compress, level, digest, declaration)
+    def serialize_many(objs, stream=None, encoding=None, root=None, compress=None, level=6, digest=None,
+                       declaration=False):
+        return emit_documents(builder, objs, stream, encoding, root, compress, level, digest, declaration)
+    def measure(obj, encoding='utf-8', compress=None, level=6, declaration=False):
+        return measure_document(builder, obj, encoding, compress, level, declaration)
+    serialize.iter = iter_chunks
+    serialize.measure = measure
+    serialize.iter_write = write_to
+    serialize.many = serialize_many
+    serialize.close = getattr(builder, 'close', lambda: None)
     return serialize
@@ -0,0 +1,139 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Analysis of the values a compiled template looks up in its object.
+"""
+
+from __future__ import absolute_import
+import collections
+from . import ast
+
+class Dependency(object):
+    """
+    Node in the tree of paths looked up by a template.
+
+    Children maps each key looked up on the value to the node for its result,
+    and items is the node for the items of the value if it is iterated. The
+    flags tell whether the value itself is rendered as tag name, attribute or
+    text, tested by a condition, or iterated by a repetition. Values that are
+    only looked up inside conditional branches are optional.
+    """
+    def __init__(self, key=None):
+        self.key = key
+        self.children = collections.OrderedDict()
+        self.items = None
+        self.rendered = self.tested = self.iterated = False
+        self.optional = True
+
+    def child(self, key):
+        if key not in self.children:
+            self.children[key] = Dependency(key)
+        return self.children[key]
+
+    def item(self):
+        if self.items is None:
+            self.items = Dependency('*')
+        return self.items
+
+    def walk(self, path=()):
+        """Yields (path, node) for this node and all nodes below it, with '*' for items"""
+        yield path, self
+        for key, child in self.children.iteritems():
+            for entry in child.walk(path + (key,)):
+                yield entry
+        if self.items is not None:
+            for entry in self.items.walk(path + ('*',)):
+                yield entry
+
+    def __repr__(self):
+        flags = [name for name in ('rendered', 'tested', 'iterated', 'optional') if getattr(self, name)]
+        return '<Dependency %s>' % ' '.join([repr(self.key)] + flags)
+
+def _lookup(node, value, required):
+    """Returns the node for the value looked up by handler value, or None for literals"""
+    if not isinstance(value, ast.AttrLookup):
+        return None
+    if required:
+        node.optional = False
+    for key in value.keys:
+        node = node.child(key)
+        if required:
+            node.optional = False
+    return node
+
+def _use(node, value, required, flag):
+    node = _lookup(node, value, required)
+    if node is not None:
+        setattr(node, flag, True)
+
+def _analyze(handler, node, required):
+    if isinstance(handler, ast.Document):
+        _analyze(handler.handler, node, required)
+
+    elif isinstance(handler, ast.Fragment):
+        for h in handler.handlers:
+            _analyze(h, node, required)
+
+    elif isinstance(handler, ast.Tag):
+        _use(node, handler.name, required, 'rendered')
+        for h in handler.handlers:
+            _analyze(h, node, required)
+
+    elif isinstance(handler, ast.Group):
+        node = _lookup(node, handler.lookup, required)
+        for h in handler.handlers:
+            _analyze(h, node, required)
+
+    elif isinstance(handler, ast.Attribute):
+        _use(node, handler.attr, required, 'rendered')
+        _use(node, handler.value, required, 'rendered')
+
+    elif isinstance(handler, ast.Text):
+        _use(node, handler.text, required, 'rendered')
+
+    elif isinstance(handler, ast.Conditional):
+        _use(node, handler.lhs, required, 'tested')
+        if handler.rhs is not None:
+            _use(node, handler.rhs, required, 'tested')
+        _analyze(handler.iftrue, node, False)
+        if handler.iffalse is not None:
+            _analyze(handler.iffalse, node, False)
+
+    elif isinstance(handler, ast.Dispatch):
+        _use(node, handler.lhs, required, 'tested')
+        for h in handler.handlers:
+            if h is not None:
+                _analyze(h, node, False)
+
+    elif isinstance(handler, ast.Repetition) and isinstance(handler.replist, ast.List):
+        source = _lookup(node, handler.replist.handler, required)
+        for bound in handler.replist.bounds or ():
+            _lookup(node, bound, required)
+        if source is None:
+            # items of a fixed count are numbers, not part of the object
+            items = Dependency('*')
+        else:
+            source.iterated = True
+            items = source.item()
+            if required:
+                items.optional = False
+        _analyze(handler.handler, items, required)
+
+def dependencies(root):
+    """Returns the Dependency tree of the values looked up by a compiled Document or Fragment"""
+    node = Dependency()
+    node.optional = False
+    _analyze(root, node, True)
+    return node
@@ -13,7 +13,9 @@
 # limitations under the License.
 
 import collections
-from xml.sax.saxutils import escape
+import itertools
+import types
+from .escape import escape_text, escape_attr
 from .utils import force_unicode
 import re
 
@@ -62,31 +64,131 @@ class Element(collections.namedtuple('Element', 'tag attrs content')):
         unicode_stream.write(self.tag)
         unicode_stream.write(u'>')
 
-class AttrLookup(object):
-
-    def __init__(self, keys):
-        self.keys = keys or []
-
-    def _lookup(self, obj, key):
+class Markup(unicode):
+    """Pre-rendered markup, written out verbatim"""
+    def write_xml(self, unicode_stream):
+        unicode_stream.write(self)
+
+class Lazy(object):
+    """
+    Value computed by func(*args, **kwargs) when a handler first reaches it.
+    The result is kept, so that the function runs once per Lazy, or once per
+    thread for threads racing to compute it.
+    """
+    _unset = object()
+
+    def __init__(self, func, args=(), kwargs=None):
+        self.func, self.args, self.kwargs = func, args, kwargs or {}
+        self._value = self._unset
+
+    def get(self):
+        value = self._value
+        if value is self._unset:
+            value = self._value = self.func(*self.args, **self.kwargs)
+        return value
+
+def resolve(value):
+    """Returns the value of a Lazy, or value itself for anything else"""
+    if type(value) is Lazy:
+        return value.get()
+    return value
+
+class KeyLookup(object):
+    """
+    Looks up a single key, as index or key for integers and as key or
+    attribute for names.
+
+    Remembers for each type of object which kind of access succeeded and
+    tries that first next time. Types are assumed to consistently accept or
+    reject a kind of key; a failed fast path falls back to the full lookup.
+
+    Lazy values are computed when looked up. Objects looked up in must
+    already be resolved.
+    """
+    max_types = 8
+
+    def __init__(self, key):
+        self.key = key
+        self._skey = str(key) if type(key) == int else None
+        self._strategies = {}
+
+    def __getstate__(self):
+        return {'key': self.key}
+
+    def __setstate__(self, state):
+        self.__init__(state['key'])
+
+    def _item(self, obj):
+        return obj[self.key]
+
+    def _str_item(self, obj):
+        # only used for dicts, where this is exactly what lookup does
+        if self.key in obj:
+            return obj[self.key]
+        return obj[self._skey]
+
+    def _attr(self, obj):
+        return getattr(obj, self.key)
+
+    def _probe(self, obj):
+        key = self.key
         if type(key) == int:
-            # int, try to use as index, then key
             try:
-                return obj[key]
+                value = obj[key]
+                strategy = self._item
             except KeyError:
-                return obj[str(key)]
+                value = obj[self._skey]
+                strategy = self._str_item if isinstance(obj, dict) else None
             except IndexError as e:
                 raise KeyError(str(e))
         else:
-            # lookup as key if possible, else attribute
+            strategy = None
             if hasattr(obj, "__getitem__"):
                 try:
-                    return obj[key]
+                    value = obj[key]
+                    strategy = self._item
                 except TypeError:
                     pass
-            return getattr(obj, key)
+            if strategy is None:
+                value = getattr(obj, key)
+                strategy = self._attr
+
+        cls = type(obj)
+        # old-style instances all share one type, so they cannot be told apart
+        if strategy is not None and cls is not types.InstanceType \
+                and len(self._strategies) < self.max_types:
+            self._strategies[cls] = strategy
+        return value
+
+    def __call__(self, obj):
+        strategy = self._strategies.get(type(obj))
+        if strategy is None:
+            value = self._probe(obj)
+        else:
+            try:
+                value = strategy(obj)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                value = self._probe(obj)
+        if type(value) is Lazy:
+            value = value.get()
+        return value
+
+class AttrLookup(object):
+    """
+    Looks up a path of keys. The object itself may be Lazy, as the root
+    object and repeated items are, and is computed first.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys or []
+        self.steps = [KeyLookup(key) for key in self.keys]
 
     def __call__(self, obj):
-        return reduce(self._lookup, self.keys, obj)
+        if type(obj) is Lazy:
+            obj = obj.get()
+        for step in self.steps:
+            obj = step(obj)
+        return obj
 
 class Literal(object):
 
@@ -96,18 +198,33 @@ class Literal(object):
     def __call__(self, obj):
         return self.value
 
+def iterable(value):
+    if hasattr(value, 'iteritems'):
+        return value.iteritems()
+    elif hasattr(value, 'items'):
+        return value.items()
+    elif type(value) == int:
+        return xrange(value)
+    else:
+        return value
+
+def window(items, start, stop, step):
+    """Iterates over a slice of items without copying them; bounds may be None"""
+    return itertools.islice(items,
+                            None if start is None else int(start),
+                            None if stop is None else int(stop),
+                            None if step is None else int(step))
+
 class List(object):
-    def __init__(self, handler):
+    def __init__(self, handler, bounds=None):
         self.handler = handler
+        self.bounds = bounds # (start, stop, step) value handlers or None
 
     def __call__(self, obj):
-        value = self.handler(obj)
-        if hasattr(value, 'items'):
-            return value.items()
-        elif type(value) == int:
-            return list(range(value))
-        else:
-            return value
+        items = iterable(self.handler(obj))
+        if self.bounds is not None:
+            items = window(items, *[b(obj) if b is not None else None for b in self.bounds])
+        return items
 
 class Group(object):
     def __init__(self, lookup, handlers):
@@ -119,34 +236,144 @@ class Group(object):
         for handler in self.handlers:
             handler(obj, cur)
 
+    def emit(self, obj, out):
+        obj = self.lookup(obj)
+        for handler in self.handlers:
+            handler.emit(obj, out)
+
+    def iter_emit(self, obj, out):
+        obj = self.lookup(obj)
+        for handler in self.handlers:
+            for _ in handler.iter_emit(obj, out):
+                yield _
+
 class Conditional(object):
-    def __init__(self, lhs, op, rhs, iftrue, iffalse):
+    def __init__(self, lhs, op, rhs, iftrue, iffalse, negate=False):
         self.lhs, self.op, self.rhs = lhs, op, rhs
         self.iftrue, self.iffalse = iftrue, iffalse
+        self.negate = negate
 
     def __call__(self, obj, cur):
         if self.rhs:
             res = self.op(self.lhs(obj), self.rhs(obj))
         else:
             res = self.op(self.lhs(obj))
+        if self.negate:
+            res = not res
         if res:
             self.iftrue(obj, cur)
         elif self.iffalse is not None:
             self.iffalse(obj, cur)
 
+    def emit(self, obj, out):
+        if self.rhs:
+            res = self.op(self.lhs(obj), self.rhs(obj))
+        else:
+            res = self.op(self.lhs(obj))
+        if self.negate:
+            res = not res
+        if res:
+            self.iftrue.emit(obj, out)
+        elif self.iffalse is not None:
+            self.iffalse.emit(obj, out)
+
+    def iter_emit(self, obj, out):
+        if self.rhs:
+            res = self.op(self.lhs(obj), self.rhs(obj))
+        else:
+            res = self.op(self.lhs(obj))
+        if self.negate:
+            res = not res
+        if res:
+            return self.iftrue.iter_emit(obj, out)
+        elif self.iffalse is not None:
+            return self.iffalse.iter_emit(obj, out)
+        return ()
+
+class Dispatch(object):
+    """
+    Chain of conditionals comparing one value for equality with literals,
+    which selects its branch with a single dictionary lookup.
+    """
+    # types whose hashing agrees with == against the literals
+    exact_types = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+    def __init__(self, lhs, branches, default):
+        self.lhs = lhs
+        self.branches = branches
+        self.default = default
+        self.handlers = [handler for literal, handler in branches] + [default]
+        self.cases = {}
+        for i, (literal, handler) in enumerate(branches):
+            # the first of several equal literals wins, as in the chain
+            self.cases.setdefault(literal, i)
+
+    def index(self, value):
+        """Returns the index of the matching branch, or len(branches) for the default"""
+        if type(value) in self.exact_types:
+            return self.cases.get(value, len(self.branches))
+        for i, (literal, handler) in enumerate(self.branches):
+            if value == literal:
+                return i
+        return len(self.branches)
+
+    def __call__(self, obj, cur):
+        handler = self.handlers[self.index(self.lhs(obj))]
+        if handler is not None:
+            handler(obj, cur)
+
+    def emit(self, obj, out):
+        handler = self.handlers[self.index(self.lhs(obj))]
+        if handler is not None:
+            handler.emit(obj, out)
+
+    def iter_emit(self, obj, out):
+        handler = self.handlers[self.index(self.lhs(obj))]
+        if handler is not None:
+            return handler.iter_emit(obj, out)
+        return ()
+
 class Attribute(object):
-    def __init__(self, attr, value):
+    def __init__(self, attr, value, memo=None):
         self.attr, self.value = attr, value
+        self.memo = memo
 
     def __call__(self, obj, cur):
-        cur.attrs.append((check_attr(force_unicode(self.attr(obj))), escape(force_unicode(self.value(obj)))))
+        if self.memo is None:
+            cur.attrs.append((check_attr(force_unicode(self.attr(obj))), escape_attr(force_unicode(self.value(obj)))))
+        else:
+            cur.attrs.append((check_attr(force_unicode(self.attr(obj))), self.memo(self.value(obj))))
+
+    def emit(self, obj, out):
+        if self.memo is None:
+            out.attr(check_attr(force_unicode(self.attr(obj))), escape_attr(force_unicode(self.value(obj))))
+        else:
+            out.attr(check_attr(force_unicode(self.attr(obj))), self.memo(self.value(obj)))
+
+    def iter_emit(self, obj, out):
+        self.emit(obj, out)
+        return ()
 
 class Text(object):
-    def __init__(self, text):
+    def __init__(self, text, memo=None):
         self.text = text
+        self.memo = memo
 
     def __call__(self, obj, cur):
-        cur.content.append(escape(force_unicode(self.text(obj))))
+        if self.memo is None:
+            cur.content.append(escape_text(force_unicode(self.text(obj))))
+        else:
+            cur.content.append(self.memo(self.text(obj)))
+
+    def emit(self, obj, out):
+        if self.memo is None:
+            out.text(escape_text(force_unicode(self.text(obj))))
+        else:
+            out.text(self.memo(self.text(obj)))
+
+    def iter_emit(self, obj, out):
+        self.emit(obj, out)
+        return ()
 
 class Tag(object):
     def __init__(self, name, handlers):
@@ -161,6 +388,73 @@ class Tag(object):
         else:
             return tag
 
+    def emit(self, obj, out):
+        out.start(check_tag(force_unicode(self.name(obj))))
+        for handler in self.handlers:
+            handler.emit(obj, out)
+        out.end()
+
+    def iter_emit(self, obj, out):
+        out.start(check_tag(force_unicode(self.name(obj))))
+        for handler in self.handlers:
+            for _ in handler.iter_emit(obj, out):
+                yield _
+        out.end()
+
+class StaticTag(Tag):
+    """Tag with a literal name that was validated at compile time"""
+    def __call__(self, obj, cur):
+        tag = Element(self.name, [], [])
+        for handler in self.handlers:
+            handler(obj, tag)
+        if cur:
+            cur.content.append(tag)
+        else:
+            return tag
+
+    def emit(self, obj, out):
+        out.start(self.name)
+        for handler in self.handlers:
+            handler.emit(obj, out)
+        out.end()
+
+    def iter_emit(self, obj, out):
+        out.start(self.name)
+        for handler in self.handlers:
+            for _ in handler.iter_emit(obj, out):
+                yield _
+        out.end()
+
+class StaticAttribute(object):
+    """Attribute with a literal name and value, validated and escaped at compile time"""
+    def __init__(self, attr, value):
+        self.attr, self.value = attr, value
+
+    def __call__(self, obj, cur):
+        cur.attrs.append((self.attr, self.value))
+
+    def emit(self, obj, out):
+        out.attr(self.attr, self.value)
+
+    def iter_emit(self, obj, out):
+        out.attr(self.attr, self.value)
+        return ()
+
+class Static(object):
+    """Content that does not depend on the object, rendered at compile time"""
+    def __init__(self, markup):
+        self.markup = Markup(markup)
+
+    def __call__(self, obj, cur):
+        cur.content.append(self.markup)
+
+    def emit(self, obj, out):
+        out.text(self.markup)
+
+    def iter_emit(self, obj, out):
+        out.text(self.markup)
+        return ()
+
 class Repetition(object):
     def __init__(self, replist, handler):
         self.replist, self.handler = replist, handler
@@ -175,10 +469,32 @@ class Repetition(object):
         if not cur:
             return cur_.content
 
+    def emit(self, obj, out):
+        for item in self.replist(obj):
+            self.handler.emit(item, out)
+
+    def iter_emit(self, obj, out):
+        # yield after every item so that the caller may flush its output
+        # before the next item is pulled from the source
+        for item in self.replist(obj):
+            for _ in self.handler.iter_emit(item, out):
+                yield _
+            yield
+
 class Fragment(object):
+    single_root = False
+    memos = ()
+
     def __init__(self, handlers):
         self.handlers = handlers
 
+    def memo_stats(self):
+        return [memo.stats() for memo in self.memos]
+
+    def dependencies(self):
+        from . import analysis
+        return analysis.dependencies(self)
+
     def __call__(self, obj):
         parent = Element(":", [], [])
         for handler in self.handlers:
@@ -186,12 +502,37 @@ class Fragment(object):
 
         return parent.content
 
+    def emit(self, obj, out):
+        for handler in self.handlers:
+            handler.emit(obj, out)
+
+    def iter_emit(self, obj, out):
+        for handler in self.handlers:
+            for _ in handler.iter_emit(obj, out):
+                yield _
+
 class Document(object):
+    single_root = True
+    memos = ()
+
     def __init__(self, handler):
         self.handler = handler
 
+    def memo_stats(self):
+        return [memo.stats() for memo in self.memos]
+
+    def dependencies(self):
+        from . import analysis
+        return analysis.dependencies(self)
+
     def __call__(self, obj):
         parent = Element(":", [], [])
         self.handler(obj, parent)
         return parent.content[0]
 
+    def emit(self, obj, out):
+        self.handler.emit(obj, out)
+
+    def iter_emit(self, obj, out):
+        return self.handler.iter_emit(obj, out)
+
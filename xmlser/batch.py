@@ -0,0 +1,105 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Batched loading of attributes of repeated items.
+
+A BatchAttribute on a class declares an attribute whose values are fetched
+by a loader taking a list of instances and returning their values in the
+same order. While items come from a source wrapped with batched, the first
+access to such an attribute loads it for the whole window of items the
+wrapper has pulled ahead, so that rendering a repetition takes one loader
+call per window instead of one per item::
+
+    class Order(object):
+        customer = BatchAttribute(load_customers)
+
+    xmlser.serialize('<orders<order*?&.customer.name>>', batched(orders, 100))
+"""
+
+from __future__ import absolute_import
+import itertools
+import threading
+
+_state = threading.local()
+
+def _windows():
+    try:
+        return _state.windows
+    except AttributeError:
+        _state.windows = []
+        return _state.windows
+
+def batched(items, window=100):
+    """
+    Yields the items, pulling them window items at a time so that batch
+    attributes can be loaded for each window at once.
+    """
+    items = iter(items)
+    windows = _windows()
+    while True:
+        chunk = list(itertools.islice(items, window))
+        if not chunk:
+            return
+        # windows are kept as (ids, items) pairs, innermost last
+        current = (frozenset(id(item) for item in chunk), chunk)
+        windows.append(current)
+        try:
+            for item in chunk:
+                yield item
+        finally:
+            for i in range(len(windows) - 1, -1, -1):
+                if windows[i] is current:
+                    del windows[i]
+                    break
+
+class BatchAttribute(object):
+    """
+    Descriptor for an attribute loaded by loader(instances). Loaded values
+    are kept on the instances. Outside of a batched window, or for items in
+    none, each instance is loaded on its own.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self._types = {} # whether instances of a type have this attribute
+
+    def _values(self, obj):
+        return obj.__dict__.setdefault('_xmlser_batch', {})
+
+    def _has(self, obj):
+        cls = type(obj)
+        try:
+            return self._types[cls]
+        except KeyError:
+            has = self._types[cls] = any(self in vars(c).values() for c in cls.__mro__)
+            return has
+
+    def _load(self, objs):
+        values = self.loader(objs)
+        for obj, value in zip(objs, values):
+            self._values(obj)[self] = value
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        values = self._values(obj)
+        if self not in values:
+            for ids, items in reversed(_windows()):
+                if id(obj) in ids:
+                    self._load([item for item in items
+                                if self._has(item) and self not in self._values(item)])
+                    break
+            else:
+                self._load([obj])
+        return values[self]
@@ -0,0 +1,191 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+import collections
+import cPickle
+import errno
+import hashlib
+import inspect
+import os
+import sys
+import tempfile
+import threading
+from . import __version__, compiler
+
+_package = __name__.rsplit('.', 1)[0] + '.'
+_sources = None
+
+def sources_digest():
+    """
+    Returns a hash of the sources of the xmlser modules, which determine the
+    layout of pickled templates.
+    """
+    global _sources
+    if _sources is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.sha1()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                digest.update(name + '\0')
+                with open(os.path.join(directory, name), 'rb') as f:
+                    digest.update(f.read())
+        _sources = digest.hexdigest()
+    return _sources
+
+def _valid(obj):
+    """
+    Checks that the xmlser objects in a loaded template have the attributes
+    their classes set, which pickles of older layouts may lack.
+    """
+    if isinstance(obj, (list, tuple)):
+        return all(_valid(item) for item in obj)
+    if isinstance(obj, dict):
+        return all(_valid(item) for item in obj.values())
+    cls = type(obj)
+    if not cls.__module__.startswith(_package) or not hasattr(obj, '__dict__'):
+        return True
+    init = getattr(cls.__init__, 'im_func', None)
+    if init is not None:
+        args = inspect.getargspec(init).args[1:]
+        if not all(hasattr(obj, arg) for arg in args):
+            return False
+    return all(_valid(value) for value in vars(obj).values())
+
+class DiskCache(object):
+    """
+    Stores compiled templates as pickles in a directory, so that other
+    processes can load them instead of compiling the format string again.
+
+    Files are named by a hash of the format string, the compile options, the
+    library version and sources and the python version. Files that cannot be
+    loaded, do not match the requested template or hold objects missing
+    attributes of their classes are replaced by a fresh compile. If the
+    directory cannot be read or written, get compiles without the cache.
+    """
+    _magic = 'xmlser-template\n'
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _key(self, fmt, options):
+        return (__version__, sources_digest(), sys.version_info[:2], fmt, tuple(sorted(options.items())))
+
+    def path(self, fmt, **options):
+        digest = hashlib.sha1(repr(self._key(fmt, options))).hexdigest()
+        return os.path.join(self.directory, digest + '.xmlt')
+
+    def load(self, fmt, **options):
+        """Returns the stored template, or None if there is no valid one"""
+        try:
+            with open(self.path(fmt, **options), 'rb') as f:
+                if f.read(len(self._magic)) != self._magic:
+                    return None
+                key, builder = cPickle.load(f)
+        except (IOError, OSError):
+            # missing file or unusable directory
+            return None
+        except Exception:
+            # truncated or otherwise corrupt file
+            return None
+        if key != self._key(fmt, options) or not _valid(builder):
+            return None
+        return builder
+
+    def store(self, fmt, builder, **options):
+        path = self.path(fmt, **options)
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write to a temporary file first so that readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._magic)
+                cPickle.dump((self._key(fmt, options), builder), f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def get(self, fmt, **options):
+        builder = self.load(fmt, **options)
+        if builder is None:
+            builder = compiler.Compiler(fmt).compile(**options)
+            try:
+                self.store(fmt, builder, **options)
+            except (IOError, OSError):
+                # the cache only saves time, so rendering goes on without it
+                pass
+        return builder
+
+class TemplateCache(object):
+    """
+    Thread-safe LRU cache of compiled templates, keyed by format string and
+    compile options.
+
+    At most maxsize templates are kept; the least recently used template is
+    evicted when a new one is added to a full cache. If a DiskCache is set as
+    disk, templates missing from memory are loaded from or stored to it.
+    """
+    def __init__(self, maxsize=256, disk=None):
+        self.maxsize = maxsize
+        self.disk = disk
+        self._templates = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, fmt, **options):
+        key = (fmt, tuple(sorted(options.items())))
+        with self._lock:
+            if key in self._templates:
+                self.hits += 1
+                builder = self._templates.pop(key)
+                self._templates[key] = builder
+                return builder
+            self.misses += 1
+
+        # compile without holding the lock; if another thread compiled the
+        # same template meanwhile, the first one stored wins
+        if self.disk is not None:
+            builder = self.disk.get(fmt, **options)
+        else:
+            builder = compiler.Compiler(fmt).compile(**options)
+
+        with self._lock:
+            if key in self._templates:
+                return self._templates[key]
+            self._templates[key] = builder
+            while len(self._templates) > max(self.maxsize, 0):
+                self._templates.popitem(last=False)
+                self.evictions += 1
+        return builder
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        size=len(self._templates), maxsize=self.maxsize)
+
+    def __len__(self):
+        return len(self._templates)
+
+# cache used by serialize, iter_serialize and make_serializer
+templates = TemplateCache()
@@ -0,0 +1,396 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generates a flat python function from a compiled handler tree.
+
+The generated functions take the same (obj, out) arguments as the emit and
+iter_emit methods of the handlers, but inline lookups, conditions and loops
+instead of calling a handler object per node.
+"""
+
+from __future__ import absolute_import
+import codecs
+import collections
+import operator
+import re
+from . import ast, writer
+from .escape import escape_text, escape_attr
+from .utils import force_text, force_unicode
+
+_conditions = {
+    operator.truth: '%s',
+    operator.eq: '%s == %s',
+    operator.lt: '%s < %s',
+    operator.gt: '%s > %s',
+    operator.contains: '_contains(%s, %s)',
+}
+
+_identifier = re.compile(r'^[A-Za-z0-9_]+$')
+
+_namespace = {
+    '_iterable': ast.iterable,
+    '_window': ast.window,
+    '_Lazy': ast.Lazy,
+    '_contains': operator.contains,
+    'check_tag': ast.check_tag,
+    'check_attr': ast.check_attr,
+    'force_unicode': force_unicode,
+    'force_text': force_text,
+    'escape_text': escape_text,
+    'escape_attr': escape_attr,
+}
+
+class Generator(object):
+
+    def __init__(self, constants, iterate=False, shared=(), encoding=None):
+        self.constants = constants # objects the generated code refers to
+        self.iterate = iterate # yield after repeated items, as iter_emit does
+        self.shared = shared # (object, keys) lookup prefixes to keep in locals
+        self.encoding = encoding # native encoding to pre-encode markup in
+        self.force = 'force_unicode' if encoding is None else 'force_text'
+        self.lines = []
+        self.level = 0
+        self.nvars = 0
+        self.yields = False
+        self.uses = collections.defaultdict(int) # evaluations per lookup prefix
+        self.prefixes = {} # local variable per shared lookup prefix
+        self.available = {} # shared lookup prefixes evaluated at this point
+        self._handlers = {
+            ast.Tag: self._tag,
+            ast.Attribute: self._attr,
+            ast.Text: self._text,
+            ast.Group: self._group,
+            ast.Conditional: self._cond,
+            ast.Repetition: self._rep,
+            ast.StaticTag: self._static_tag,
+            ast.StaticAttribute: self._static_attr,
+            ast.Dispatch: self._dispatch,
+            ast.Static: self._static_markup,
+        }
+
+    def line(self, code):
+        self.lines.append('    ' * self.level + code)
+
+    def var(self, prefix='o'):
+        self.nvars += 1
+        return '%s%d' % (prefix, self.nvars)
+
+    def constant(self, value, prefix='_c', suffix=''):
+        name = '%s%d%s' % (prefix, len(self.constants), suffix)
+        self.constants[name] = value
+        return name
+
+    def value(self, node, obj):
+        if isinstance(node, ast.AttrLookup):
+            # continue from the longest prefix that was already evaluated
+            start, expr = 0, obj
+            for i in range(len(node.keys), 0, -1):
+                if (obj, tuple(node.keys[:i])) in self.available:
+                    start, expr = i, self.available[obj, tuple(node.keys[:i])]
+                    break
+
+            # the lookup sites are shared with the handler tree, so that both
+            # remember the same access strategies
+            for i in range(start, len(node.keys)):
+                step = node.steps[i]
+                # name the site after the key where possible, for readability
+                named = isinstance(step.key, (int, long)) or \
+                        (isinstance(step.key, str) and _identifier.match(step.key))
+                suffix = '_%s' % step.key if named else ''
+                expr = '%s(%s)' % (self.constant(step, '_k', suffix), expr)
+
+                prefix = (obj, tuple(node.keys[:i+1]))
+                self.uses[prefix] += 1
+                if prefix in self.shared:
+                    var = self.prefixes.setdefault(prefix, 'p%d' % (len(self.prefixes) + 1))
+                    self.line('%s = %s' % (var, expr))
+                    self.available[prefix] = expr = var
+            return expr
+        elif isinstance(node, ast.Literal):
+            return repr(node.value)
+        else:
+            return '%s(%s)' % (self.constant(node), obj)
+
+    def literal(self, markup):
+        """Returns the expression for static markup, pre-encoded if possible"""
+        markup = unicode(markup)
+        if self.encoding is not None:
+            try:
+                return repr(markup.encode(self.encoding))
+            except UnicodeEncodeError:
+                # left for the writer to report
+                pass
+        return repr(markup)
+
+    def _static(self, node, convert):
+        # convert literals at compile time, leaving failures to render time
+        if isinstance(node, ast.Literal):
+            try:
+                return convert(force_unicode(node.value))
+            except ValueError:
+                pass
+        return None
+
+    def _converted(self, node, obj, convert, name, force='force_unicode'):
+        static = self._static(node, convert)
+        if static is not None:
+            return self.literal(static)
+        return '%s(%s(%s))' % (name, force, self.value(node, obj))
+
+    def handlers(self, handlers, obj):
+        text = []
+        for handler in handlers:
+            static = None
+            if isinstance(handler, ast.Static):
+                static = handler.markup
+            elif isinstance(handler, ast.Text):
+                static = self._static(handler.text, escape_text)
+            if static is not None:
+                text.append(static)
+                continue
+            if text:
+                self.line('text(%s)' % self.literal(u''.join(text)))
+                text = []
+            self.handler(handler, obj)
+        if text:
+            self.line('text(%s)' % self.literal(u''.join(text)))
+
+    def handler(self, node, obj):
+        generate = self._handlers.get(type(node))
+        if generate is None and self.iterate:
+            self.line('for _ in %s.iter_emit(%s, out):' % (self.constant(node), obj))
+            self.line('    yield')
+            self.yields = True
+        elif generate is None:
+            self.line('%s.emit(%s, out)' % (self.constant(node), obj))
+        else:
+            generate(node, obj)
+
+    def block(self, generate):
+        self.level += 1
+        size = len(self.lines)
+        generate()
+        if len(self.lines) == size:
+            self.line('pass')
+        self.level -= 1
+
+    def branch(self, cond, iftrue, iffalse=None):
+        """Emits an if/else with blocks generated by the iftrue and iffalse functions"""
+        self.line('if %s:' % cond)
+        before = dict(self.available)
+        self.block(iftrue)
+        available, self.available = self.available, before
+        if iffalse is not None:
+            self.line('else:')
+            self.block(iffalse)
+        # only values evaluated on both paths remain available
+        self.available = dict((prefix, var) for prefix, var in available.items()
+                              if self.available.get(prefix) == var)
+
+    def _tag(self, node, obj):
+        self.line('start(%s)' % self._converted(node.name, obj, ast.check_tag, 'check_tag'))
+        self.handlers(node.handlers, obj)
+        self.line('end()')
+
+    def _static_tag(self, node, obj):
+        self.line('start(%s)' % self.literal(node.name))
+        self.handlers(node.handlers, obj)
+        self.line('end()')
+
+    def _static_markup(self, node, obj):
+        self.line('text(%s)' % self.literal(node.markup))
+
+    def _static_attr(self, node, obj):
+        self.line('attr(%s, %s)' % (self.literal(node.attr), self.literal(node.value)))
+
+    def _attr(self, node, obj):
+        attr = self._converted(node.attr, obj, ast.check_attr, 'check_attr')
+        if node.memo is None:
+            value = self._converted(node.value, obj, escape_attr, 'escape_attr', self.force)
+        else:
+            value = '%s(%s)' % (self.constant(node.memo, '_m'), self.value(node.value, obj))
+        self.line('attr(%s, %s)' % (attr, value))
+
+    def _text(self, node, obj):
+        if node.memo is None:
+            self.line('text(%s)' % self._converted(node.text, obj, escape_text, 'escape_text', self.force))
+        else:
+            self.line('text(%s(%s))' % (self.constant(node.memo, '_m'), self.value(node.text, obj)))
+
+    def _group(self, node, obj):
+        if node.lookup.keys:
+            var = self.var()
+            self.line('%s = %s' % (var, self.value(node.lookup, obj)))
+            obj = var
+        self.handlers(node.handlers, obj)
+
+    def _cond(self, node, obj):
+        args = (self.value(node.lhs, obj),)
+        if node.rhs:
+            args += (self.value(node.rhs, obj),)
+        if node.op in _conditions:
+            cond = _conditions[node.op] % args
+        else:
+            cond = '%s(%s)' % (self.constant(node.op), ', '.join(args))
+        if node.negate:
+            cond = 'not (%s)' % cond
+        iffalse = None
+        if node.iffalse is not None:
+            iffalse = lambda: self.handler(node.iffalse, obj)
+        self.branch(cond, lambda: self.handler(node.iftrue, obj), iffalse)
+
+    def _dispatch(self, node, obj):
+        # select the branch by index, then find it by bisecting the indices
+        var = self.var('i')
+        self.line('%s = %s.index(%s)' % (var, self.constant(node, '_d'), self.value(node.lhs, obj)))
+        self._cases(node.handlers, var, 0, len(node.handlers), obj)
+
+    def _cases(self, handlers, var, lo, hi, obj):
+        if hi - lo == 1:
+            if handlers[lo] is not None:
+                self.handler(handlers[lo], obj)
+        else:
+            mid = (lo + hi) // 2
+            self.branch('%s < %d' % (var, mid),
+                        lambda: self._cases(handlers, var, lo, mid, obj),
+                        lambda: self._cases(handlers, var, mid, hi, obj))
+
+    def _rep(self, node, obj):
+        replist = node.replist
+        counted = isinstance(replist, ast.List) and isinstance(replist.handler, ast.Literal) \
+                and type(replist.handler.value) == int and replist.bounds is None
+        if counted:
+            items = 'xrange(%d)' % replist.handler.value
+        elif isinstance(replist, ast.List):
+            items = '_iterable(%s)' % self.value(replist.handler, obj)
+            if replist.bounds is not None:
+                items = '_window(%s, %s)' % (items, ', '.join(
+                    'None' if b is None else self.value(b, obj) for b in replist.bounds))
+        else:
+            items = self.value(replist, obj)
+        var = self.var()
+        self.line('for %s in %s:' % (var, items))
+        # values evaluated in the loop are not available if it runs zero times
+        before = dict(self.available)
+        self.level += 1
+        if not counted:
+            # items may be Lazy, like the root object
+            self.line('if type(%s) is _Lazy: %s = %s.get()' % (var, var, var))
+        self.handler(node.handler, var)
+        if self.iterate:
+            self.line('yield')
+            self.yields = True
+        self.level -= 1
+        self.available = before
+
+    def function(self, name, root):
+        self.line('def %s(obj, out):' % name)
+        self.level += 1
+        self.line('start, attr, text, end = out.start, out.attr, out.text, out.end')
+        self.line('if type(obj) is _Lazy: obj = obj.get()')
+        if isinstance(root, ast.Document):
+            self.handlers([root.handler], 'obj')
+        else:
+            self.handlers(root.handlers, 'obj')
+        if self.iterate and not self.yields:
+            self.line('return ()')
+        self.level -= 1
+        return '\n'.join(self.lines) + '\n'
+
+def generate(root, name, constants, iterate=False, encoding=None):
+    """
+    Returns the source of a function emitting root. Lookup prefixes that are
+    evaluated more than once per object are kept in local variables, which
+    are filled when first needed on each path through the function.
+
+    With an encoding from utils.native_encodings, static markup is emitted as
+    byte strings in that encoding, for use with writer.EncodedWriter.
+    """
+    counting = Generator({}, iterate)
+    counting.function(name, root)
+    shared = set(prefix for prefix, uses in counting.uses.items() if uses > 1)
+    return Generator(constants, iterate, shared, encoding).function(name, root)
+
+def _load(source, constants):
+    namespace = dict(_namespace)
+    namespace.update(constants)
+    exec compile(source, '<xmlser template>', 'exec') in namespace
+    return namespace
+
+class Template(object):
+    """
+    Builder generated from the handler tree of a Document or Fragment.
+
+    Behaves like the tree it was generated from; the generated source is
+    available as the source attribute. Pickling keeps the source, so that
+    unpickling only needs to compile it again.
+
+    Functions emitting pre-encoded markup are generated on first use for
+    each encoding, see encoded.
+    """
+    def __init__(self, root):
+        constants = {}
+        source = generate(root, 'emit', constants) + '\n' + \
+                 generate(root, 'iter_emit', constants, iterate=True)
+        self._load(root, source, constants)
+
+    def _load(self, root, source, constants):
+        self.root = root
+        self.single_root = root.single_root
+        self.memos = root.memos
+        self.source = source
+        self.constants = constants
+
+        namespace = _load(source, constants)
+        self.emit = namespace['emit']
+        self.iter_emit = namespace['iter_emit']
+        self._encoded = {}
+
+    def encoded(self, encoding):
+        """
+        Returns the emit and iter_emit functions writing static markup
+        pre-encoded in encoding, which must be one of utils.native_encodings.
+        """
+        encoding = codecs.lookup(encoding).name
+        try:
+            return self._encoded[encoding]
+        except KeyError:
+            pass
+        constants = {}
+        source = generate(self.root, 'emit', constants, encoding=encoding) + '\n' + \
+                 generate(self.root, 'iter_emit', constants, iterate=True, encoding=encoding)
+        namespace = _load(source, constants)
+        functions = self._encoded[encoding] = (namespace['emit'], namespace['iter_emit'])
+        return functions
+
+    def memo_stats(self):
+        return [memo.stats() for memo in self.memos]
+
+    def dependencies(self):
+        from . import analysis
+        return analysis.dependencies(self.root)
+
+    def __getstate__(self):
+        return (self.root, self.source, self.constants)
+
+    def __setstate__(self, state):
+        self._load(*state)
+
+    def __call__(self, obj):
+        out = writer.TreeWriter()
+        self.emit(obj, out)
+        if self.single_root:
+            return out.root.content[0]
+        return out.root.content
@@ -14,7 +14,7 @@
 
 from __future__ import absolute_import
 import sys
-from . import ast, exc, utils
+from . import ast, exc, optimize, utils
 
 class Compiler(object):
 
@@ -103,7 +103,32 @@ class Compiler(object):
     def _list(self, idx):
 
         idx, value = self._val(idx, strings=False)
-        return idx, ast.List(value)
+        bounds = None
+        if self.fmt[idx] == '[':
+            idx, bounds = self._window(idx+1)
+        return idx, ast.List(value, bounds)
+
+    def _window(self, idx):
+
+        bounds = []
+        while True:
+            if self.fmt[idx] in ':]':
+                bounds.append(None)
+            else:
+                idx, bound = self._val(idx, strings=False)
+                bounds.append(bound)
+            if self.fmt[idx] == ']' or len(bounds) == 3:
+                break
+            if self.fmt[idx] != ':':
+                raise exc.InvalidValue(self.fmt, idx)
+            idx += 1
+
+        if self.fmt[idx] != ']':
+            raise exc.InvalidValue(self.fmt, idx)
+        if len(bounds) == 1:
+            raise exc.InvalidValue(self.fmt, idx)
+        bounds.extend([None] * (3 - len(bounds)))
+        return idx+1, tuple(bounds)
 
     def _attr(self, idx):
 
@@ -153,9 +178,6 @@ class Compiler(object):
             raise exc.InvalidCondition(self.fmt, idx, "Unrecognized conditional operator")
         idx += 1
 
-        if negate:
-            op = utils.compose(operator.not_, op)
-
         rhs = None
         if binary:
             idx, rhs = self._val(idx)
@@ -166,7 +188,7 @@ class Compiler(object):
         if self.fmt[idx] == '~':
             idx, iffalse = self._intag(idx+1)
 
-        return idx, ast.Conditional(lhs, op, rhs, iftrue, iffalse)
+        return idx, ast.Conditional(lhs, op, rhs, iftrue, iffalse, negate)
 
     def _intag(self, idx):
 
@@ -211,7 +233,7 @@ class Compiler(object):
         else:
             return idx, ast.Repetition(replist, tag)
 
-    def compile(self, single_root=True):
+    def compile(self, single_root=True, backend='ast', fold=True, dispatch=True, memoize=None):
         idx = 0
         handlers = []
 
@@ -220,7 +242,7 @@ class Compiler(object):
                 idx, handler = self._tag(idx+1, True)
                 handlers = [handler]
             else:
-                while self.fmt[idx] == '<':
+                while idx < len(self.fmt) and self.fmt[idx] == '<':
                     idx, handler = self._tag(idx+1, single_root)
                     handlers.append(handler)
         except IndexError:
@@ -231,12 +253,27 @@ class Compiler(object):
             raise exc.SerializationFormatError("Unprocessed tail", self.fmt, idx)
         if single_root:
             assert len(handlers) == 1
-            return ast.Document(handlers[0])
+            root = ast.Document(handlers[0])
+        else:
+            root = ast.Fragment(handlers)
+
+        if fold:
+            root = optimize.fold(root)
+        if dispatch:
+            root = optimize.dispatch(root)
+        if memoize:
+            root = optimize.memoize(root, memoize)
+
+        if backend == 'ast':
+            return root
+        elif backend == 'codegen':
+            from . import codegen
+            return codegen.Template(root)
         else:
-            return ast.Fragment(handlers)
+            raise ValueError("Unknown backend %r" % backend)
 
-    def __call__(self, single_root=True):
-        return self.compile(single_root)
+    def __call__(self, single_root=True, backend='ast', fold=True, dispatch=True, memoize=None):
+        return self.compile(single_root, backend, fold, dispatch, memoize)
 
 def write_document(tree, stream=None, encoding=None):
     """
@@ -0,0 +1,113 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Escaping of text and attribute values.
+
+Each special character is only replaced if it occurs, so that strings
+without any are returned unchanged after a few fast scans. This beats both
+unconditional replacing and unicode.translate, which is slow in python 2.
+"""
+
+import datetime
+import decimal
+from .utils import force_unicode
+
+def escape_text(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+def escape_attr(value):
+    """Escapes like escape_text, plus quotes and whitespace that attribute value normalization would replace"""
+    if '&' in value:
+        value = value.replace('&', '&amp;')
+    if '<' in value:
+        value = value.replace('<', '&lt;')
+    if '>' in value:
+        value = value.replace('>', '&gt;')
+    if '"' in value:
+        value = value.replace('"', '&quot;')
+    if '\t' in value:
+        value = value.replace('\t', '&#9;')
+    if '\n' in value:
+        value = value.replace('\n', '&#10;')
+    if '\r' in value:
+        value = value.replace('\r', '&#13;')
+    return value
+
+# types whose values convert to the same text whenever they compare equal
+_plain_types = frozenset([str, unicode])
+# immutable types whose text only depends on type and value
+_value_types = frozenset([int, long, bool, type(None)])
+# immutable types whose equal values may differ in text, such as Decimal('1.0')
+# and Decimal('1.00') or 0.0 and -0.0, but whose text depends on the repr
+_repr_types = frozenset([float, decimal.Decimal, datetime.date, datetime.datetime, datetime.time])
+
+class Memo(object):
+    """
+    Bounded memo from raw values to their converted and escaped form, for
+    fields that take few distinct values.
+
+    Only strings and immutable builtin values are memoized, as the text of
+    other objects may change. Values that compare equal but convert to
+    different text are told apart by their repr. When full, an arbitrary entry is evicted for
+    each new value. The counters are not synchronized between threads, so
+    they are only approximate under concurrent use.
+    """
+    def __init__(self, escape, maxsize=1024, field=None):
+        self.escape = escape
+        self.maxsize = maxsize
+        self.field = field
+        self.values = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def __call__(self, value):
+        if type(value) in _plain_types:
+            key = value
+        elif type(value) in _value_types:
+            key = (type(value), value)
+        elif type(value) in _repr_types and getattr(value, 'tzinfo', None) is None:
+            # aware times are left out, as their tzinfo may not show in the repr
+            key = (type(value), repr(value))
+        else:
+            self.misses += 1
+            return self.escape(force_unicode(value))
+
+        try:
+            result = self.values[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = self.escape(force_unicode(value))
+        if len(self.values) >= self.maxsize:
+            try:
+                self.values.popitem()
+                self.evictions += 1
+            except KeyError:
+                pass
+        self.values[key] = result
+        return result
+
+    def stats(self):
+        return dict(field=self.field, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, size=len(self.values))
@@ -0,0 +1,215 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compile time transformations of handler trees.
+
+Each pass takes a freshly compiled handler and returns the handler to use in
+its place; child handlers may be replaced in place.
+"""
+
+from __future__ import absolute_import
+import operator
+from . import ast
+from .escape import Memo, escape_text, escape_attr
+from .utils import force_unicode
+
+# fixed-count repetitions of static content are only unrolled up to this size
+MAX_UNROLLED = 4096
+
+# shorter else-if chains are cheaper to evaluate as they are
+MIN_DISPATCH = 3
+
+def children(handler):
+    if isinstance(handler, ast.Document):
+        return [handler.handler]
+    elif isinstance(handler, (ast.Fragment, ast.Tag, ast.Group)):
+        return handler.handlers
+    elif isinstance(handler, ast.Repetition):
+        return [handler.handler]
+    elif isinstance(handler, ast.Conditional):
+        return [h for h in (handler.iftrue, handler.iffalse) if h is not None]
+    elif isinstance(handler, ast.Dispatch):
+        return [h for h in handler.handlers if h is not None]
+    return []
+
+def walk(handler):
+    """Yields the handler and all handlers below it, depth first"""
+    yield handler
+    for child in children(handler):
+        for h in walk(child):
+            yield h
+
+def _literal(node, convert):
+    if isinstance(node, ast.Literal):
+        try:
+            return convert(force_unicode(node.value))
+        except ValueError:
+            # invalid literals are left for render time to report
+            pass
+    return None
+
+def _fold_list(handlers):
+    folded = []
+    for handler in handlers:
+        handler = fold(handler)
+        if isinstance(handler, ast.Static) and folded and isinstance(folded[-1], ast.Static):
+            folded[-1] = ast.Static(folded[-1].markup + handler.markup)
+        else:
+            folded.append(handler)
+    return folded
+
+def fold(handler):
+    """
+    Replaces subtrees whose output does not depend on the object with
+    pre-validated and pre-escaped markup.
+    """
+    if isinstance(handler, ast.Document):
+        root = handler.handler
+        name = _literal(root.name, ast.check_tag) if isinstance(root, ast.Tag) else None
+        if name is not None:
+            # the root element stays a tag, so that tree output is an Element
+            handler.handler = ast.StaticTag(name, _fold_list(root.handlers))
+        else:
+            handler.handler = fold(root)
+
+    elif isinstance(handler, ast.Fragment):
+        handler.handlers = _fold_list(handler.handlers)
+
+    elif isinstance(handler, ast.Tag):
+        handlers = _fold_list(handler.handlers)
+        name = _literal(handler.name, ast.check_tag)
+        if name is None:
+            handler.handlers = handlers
+        elif all(isinstance(h, (ast.Static, ast.StaticAttribute)) for h in handlers):
+            attrs = u''.join(u' %s="%s"' % (h.attr, h.value)
+                             for h in handlers if isinstance(h, ast.StaticAttribute))
+            content = u''.join(h.markup for h in handlers if isinstance(h, ast.Static))
+            return ast.Static(u'<%s%s>%s</%s>' % (name, attrs, content, name))
+        else:
+            return ast.StaticTag(name, handlers)
+
+    elif isinstance(handler, ast.Attribute):
+        attr = _literal(handler.attr, ast.check_attr)
+        value = _literal(handler.value, escape_attr)
+        if attr is not None and value is not None:
+            return ast.StaticAttribute(attr, value)
+
+    elif isinstance(handler, ast.Text):
+        text = _literal(handler.text, escape_text)
+        if text is not None:
+            return ast.Static(text)
+
+    elif isinstance(handler, ast.Group):
+        handler.handlers = _fold_list(handler.handlers)
+        if not handler.lookup.keys and len(handler.handlers) == 1 \
+                and isinstance(handler.handlers[0], ast.Static):
+            return handler.handlers[0]
+
+    elif isinstance(handler, ast.Conditional):
+        handler.iftrue = fold(handler.iftrue)
+        if handler.iffalse is not None:
+            handler.iffalse = fold(handler.iffalse)
+
+    elif isinstance(handler, ast.Repetition):
+        handler.handler = fold(handler.handler)
+        replist = handler.replist
+        if isinstance(handler.handler, ast.Static) and isinstance(replist, ast.List) \
+                and replist.bounds is None and isinstance(replist.handler, ast.Literal) and type(replist.handler.value) == int \
+                and replist.handler.value * len(handler.handler.markup) <= MAX_UNROLLED:
+            return ast.Static(handler.handler.markup * replist.handler.value)
+
+    return handler
+
+def _case(cond, lhs):
+    return isinstance(cond, ast.Conditional) and cond.op is operator.eq and not cond.negate \
+        and isinstance(cond.rhs, ast.Literal) and isinstance(cond.lhs, ast.AttrLookup) \
+        and cond.lhs.keys == lhs.keys
+
+def dispatch(handler):
+    """
+    Replaces else-if chains comparing the same lookup with literals by a
+    single Dispatch handler.
+    """
+    if isinstance(handler, ast.Document):
+        handler.handler = dispatch(handler.handler)
+
+    elif isinstance(handler, (ast.Fragment, ast.Tag, ast.Group)):
+        handler.handlers = [dispatch(h) for h in handler.handlers]
+
+    elif isinstance(handler, ast.Repetition):
+        handler.handler = dispatch(handler.handler)
+
+    elif isinstance(handler, ast.Conditional):
+        branches = []
+        cond = handler
+        while _case(cond, handler.lhs):
+            branches.append((cond.rhs.value, cond.iftrue))
+            cond = cond.iffalse
+
+        if len(branches) >= MIN_DISPATCH:
+            return ast.Dispatch(handler.lhs, [(literal, dispatch(h)) for literal, h in branches],
+                                dispatch(cond) if cond is not None else None)
+        handler.iftrue = dispatch(handler.iftrue)
+        if handler.iffalse is not None:
+            handler.iffalse = dispatch(handler.iffalse)
+
+    return handler
+
+def split_repetitions(handler, make_site, sites):
+    """
+    Replaces the outermost repetitions below handler, whose items each render
+    as complete elements, by make_site(index, repetition), and appends the
+    repetitions to sites.
+    """
+    if isinstance(handler, ast.Repetition):
+        if isinstance(handler.handler, (ast.Tag, ast.Static)):
+            sites.append(handler)
+            return make_site(len(sites) - 1, handler)
+        return handler
+
+    if isinstance(handler, ast.Document):
+        handler.handler = split_repetitions(handler.handler, make_site, sites)
+    elif isinstance(handler, (ast.Fragment, ast.Tag, ast.Group)):
+        handler.handlers = [split_repetitions(h, make_site, sites) for h in handler.handlers]
+    elif isinstance(handler, ast.Conditional):
+        handler.iftrue = split_repetitions(handler.iftrue, make_site, sites)
+        if handler.iffalse is not None:
+            handler.iffalse = split_repetitions(handler.iffalse, make_site, sites)
+    return handler
+
+def _field(node):
+    if isinstance(node, ast.AttrLookup):
+        return ''.join('.%s' % key for key in node.keys) or '?'
+    elif isinstance(node, ast.Literal):
+        return '"%s"' % node.value
+    return repr(node)
+
+def memoize(root, maxsize):
+    """
+    Gives every dynamic text and attribute value its own Memo of up to
+    maxsize escaped values. The memos are listed in root.memos.
+    """
+    memos = []
+    for handler in walk(root):
+        if isinstance(handler, ast.Text) and not isinstance(handler.text, ast.Literal):
+            handler.memo = Memo(escape_text, maxsize, '&' + _field(handler.text))
+            memos.append(handler.memo)
+        elif isinstance(handler, ast.Attribute) and not isinstance(handler.value, ast.Literal):
+            handler.memo = Memo(escape_attr, maxsize, '=%s%s' % (
+                handler.attr.value if isinstance(handler.attr, ast.Literal) else _field(handler.attr),
+                _field(handler.value)))
+            memos.append(handler.memo)
+    root.memos = memos
+    return root
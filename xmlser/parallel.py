@@ -0,0 +1,138 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Rendering of large repetitions in a pool of worker processes.
+
+The outermost repetitions of whole elements are split into batches of
+consecutive items. Each batch is sent to a worker, which compiles the same
+format string and renders the items with the repetition's handler. The
+rendered batches are written out in their original order, with only a
+bounded number of them in flight at any time. Items must be picklable.
+"""
+
+from __future__ import absolute_import
+import collections
+import itertools
+import multiprocessing
+from . import ast, compiler
+from .optimize import split_repetitions
+
+def _batches(items, size):
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+# per worker process: (fmt, options) -> item renderers of the split repetitions
+_renderers = {}
+
+def _renderer(fmt, options):
+    key = (fmt, tuple(sorted(options.items())))
+    try:
+        return _renderers[key]
+    except KeyError:
+        pass
+
+    options = dict(options)
+    backend = options.pop('backend', 'ast')
+    repetitions = []
+    split_repetitions(compiler.Compiler(fmt).compile(backend='ast', **options),
+           lambda index, rep: rep, repetitions)
+    renderers = [ast.Fragment([rep.handler]) for rep in repetitions]
+    if backend == 'codegen':
+        from . import codegen
+        renderers = [codegen.Template(r) for r in renderers]
+    _renderers[key] = renderers
+    return renderers
+
+def _render(fmt, options, index, items):
+    from . import utils, writer
+    renderer = _renderer(fmt, options)[index]
+    stream = utils.ListStream()
+    out = writer.ElementWriter(stream)
+    for item in items:
+        renderer.emit(item, out)
+    return stream.getvalue()
+
+class ParallelRepetition(object):
+    """
+    Stands in for a repetition, rendering its items in batches of batch_size
+    in the pool and keeping at most max_pending batches in flight.
+    """
+    def __init__(self, renderer, index, replist):
+        self.renderer, self.index, self.replist = renderer, index, replist
+
+    def _rendered(self, obj):
+        pool, batch_size, max_pending = self.renderer.pool, self.renderer.batch_size, self.renderer.max_pending
+        args = (self.renderer.fmt, self.renderer.options, self.index)
+        pending = collections.deque()
+        # lazy items are computed here, as their functions need not pickle
+        for batch in _batches(itertools.imap(ast.resolve, self.replist(obj)), batch_size):
+            pending.append(pool.apply_async(_render, args + (batch,)))
+            if len(pending) >= max_pending:
+                yield ast.Markup(pending.popleft().get())
+        while pending:
+            yield ast.Markup(pending.popleft().get())
+
+    def __call__(self, obj, cur):
+        for markup in self._rendered(obj):
+            cur.content.append(markup)
+
+    def emit(self, obj, out):
+        for markup in self._rendered(obj):
+            out.text(markup)
+
+    def iter_emit(self, obj, out):
+        for markup in self._rendered(obj):
+            out.text(markup)
+            yield
+
+class ParallelRenderer(object):
+    """
+    Builder for fmt that renders its outermost repetitions of elements in a
+    pool of worker processes. The pool is started with the renderer and
+    stopped by close.
+    """
+    def __init__(self, fmt, workers, batch_size=1000, max_pending=None, **options):
+        if not isinstance(fmt, basestring):
+            fmt = fmt.fmt
+        self.fmt = fmt
+        self.options = options
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * workers
+
+        options = dict(options)
+        backend = options.pop('backend', 'ast')
+        self.sites = []
+        root = split_repetitions(compiler.Compiler(fmt).compile(backend='ast', **options),
+                      lambda index, rep: ParallelRepetition(self, index, rep.replist), self.sites)
+        if backend == 'codegen':
+            from . import codegen
+            root = codegen.Template(root)
+            self.encoded = root.encoded
+        self.root = root
+        self.single_root = root.single_root
+        self.emit = root.emit
+        self.iter_emit = root.iter_emit
+        self.pool = multiprocessing.Pool(workers)
+
+    def __call__(self, obj):
+        return self.root(obj)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
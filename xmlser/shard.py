@@ -0,0 +1,150 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Splitting of documents into several standalone documents.
+
+The items of one outermost repetition of elements are distributed over
+shards, each of which repeats the markup around the repetition, so that
+every shard is a complete document on its own.
+"""
+
+from __future__ import absolute_import
+from . import ast, compiler, utils, writer
+from .optimize import split_repetitions
+
+class _Site(object):
+    """
+    Stands in for the sharded repetition, remembering its items and its
+    position among the parts written to stream.
+    """
+    def __init__(self, repetition):
+        self.repetition = repetition
+        self.stream = None
+        self.items = None
+        self.position = None
+
+    def emit(self, obj, out):
+        if self.items is not None:
+            raise ValueError("Sharded repetition rendered more than once")
+        # close a pending start tag, so that the output splits between tags
+        out.text(u'')
+        self.items = self.repetition.replist(obj)
+        self.position = len(self.stream.parts)
+
+    def iter_emit(self, obj, out):
+        self.emit(obj, out)
+        return ()
+
+class ShardWriter(object):
+    """
+    Writes the output for a format string into shards of at most max_bytes
+    bytes and max_items items of the index'th outermost repetition of
+    elements. Each shard is written to a stream returned by factory(number)
+    and closed when full. An item that does not fit into an empty shard on
+    its own gets a shard of its own.
+
+    With declaration set, each shard starts with the XML declaration. The
+    format is compiled once, so a writer can write many objects, but only
+    one at a time.
+    """
+    def __init__(self, fmt, max_bytes=None, max_items=None, encoding='utf-8', index=0, declaration=False,
+                 **options):
+        if max_bytes is None and max_items is None:
+            raise ValueError("Shards need a size or item limit")
+        if not isinstance(fmt, basestring):
+            fmt = fmt.fmt
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.encoding = encoding
+        self.index = index
+        self.declaration = declaration
+        self.options = options
+        self.root, self.site, self.item = self._compile()
+
+    def _compile(self):
+        options = dict(self.options)
+        backend = options.pop('backend', 'ast')
+        replaced = []
+        def make_site(index, repetition):
+            if index != self.index:
+                return repetition
+            replaced.append(_Site(repetition))
+            return replaced[0]
+        root = split_repetitions(compiler.Compiler(self.fmt).compile(backend='ast', **options),
+                                 make_site, [])
+        if not replaced:
+            raise ValueError("Format has no repetition %d to shard" % self.index)
+        item = ast.Fragment([replaced[0].repetition.handler])
+        if backend == 'codegen':
+            from . import codegen
+            item = codegen.Template(item)
+        return root, replaced[0], item
+
+    def write(self, obj, factory):
+        """Writes the shards for obj, returning a list of (items, bytes) per shard"""
+        root, site, item = self.root, self.site, self.item
+
+        stream = site.stream = utils.ListStream()
+        site.items = site.position = None
+        root.emit(obj, writer.ElementWriter(stream))
+        if site.position is None:
+            # the repetition was not rendered, e.g. in an untaken branch
+            head, tail, items = u''.join(stream.parts), u'', ()
+        else:
+            head = u''.join(stream.parts[:site.position])
+            tail = u''.join(stream.parts[site.position:])
+            items = site.items
+
+        if self.declaration:
+            head = u'<?xml version="1.0" encoding="%s"?>' % self.encoding + head
+        head = head.encode(self.encoding)
+        tail = tail.encode(self.encoding)
+
+        shards = []
+        out = None
+        for value in items:
+            markup = utils.ListStream()
+            item.emit(value, writer.ElementWriter(markup))
+            data = u''.join(markup.parts).encode(self.encoding)
+
+            if out is not None and (
+                    (self.max_items is not None and count >= self.max_items) or
+                    (self.max_bytes is not None and size + len(data) + len(tail) > self.max_bytes)):
+                self._close(out, tail)
+                shards.append((count, size + len(tail)))
+                out = None
+            if out is None:
+                out = factory(len(shards))
+                out.write(head)
+                count, size = 0, len(head)
+            out.write(data)
+            count += 1
+            size += len(data)
+
+        if out is None:
+            # no items at all still give one document
+            out = factory(0)
+            out.write(head)
+            count, size = 0, len(head)
+        self._close(out, tail)
+        shards.append((count, size + len(tail)))
+        return shards
+
+    def _close(self, out, tail):
+        out.write(tail)
+        close = getattr(out, 'close', None)
+        if close is not None:
+            close()
@@ -12,23 +12,123 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import decimal
+import re
 import sys
+import zlib
 
-def force_unicode(txt):
+# encoding tried first when converting byte strings
+str_encoding = 'utf-8'
+
+def _decode(txt, orig=None):
     try:
-        return unicode(txt)
+        return txt.decode(str_encoding)
     except UnicodeDecodeError:
         pass
-    orig = txt
-    if type(txt) != str:
-        txt = str(txt)
     for args in [('utf-8',), ('latin1',), ('ascii', 'replace')]:
         try:
             return txt.decode(*args)
         except UnicodeDecodeError:
             pass
+    orig = txt if orig is None else orig
     raise ValueError("Unable to force %s object %r to unicode" % (type(orig).__name__, orig))
 
+def _convert(txt):
+    try:
+        return unicode(txt)
+    except UnicodeDecodeError:
+        pass
+    return _decode(str(txt), txt)
+
+_bool_text = {True: u'True', False: u'False'}
+
+# converters for exact builtin types
+_builtin = {
+    unicode: lambda txt: txt,
+    str: _decode,
+    int: unicode,
+    long: unicode,
+    float: unicode,
+    bool: _bool_text.__getitem__,
+    type(None): lambda txt: u'None',
+    decimal.Decimal: unicode,
+    datetime.date: unicode,
+    datetime.datetime: unicode,
+    datetime.time: unicode,
+}
+# converters registered by applications, which also apply to subclasses
+_registered = {}
+# converter to use for each type seen so far
+_converters = dict(_builtin)
+
+def _unregistered(converters):
+    """Returns the converters for types not covered by a registered class"""
+    return dict((cls, converter) for cls, converter in converters.items()
+                if not any(base in _registered for base in cls.__mro__))
+
+def register_converter(cls, converter):
+    """
+    Registers a function converting objects of cls and its subclasses to
+    unicode, taking precedence over the builtin conversion of cls.
+    """
+    _registered[cls] = converter
+    _reset()
+
+def _reset():
+    _converters.clear()
+    _converters.update(_unregistered(_builtin))
+    _text_converters.clear()
+    _text_converters.update(_unregistered(_builtin_text))
+
+def _resolve(cls):
+    for base in getattr(cls, '__mro__', ()):
+        if base in _registered:
+            converter = _registered[base]
+            break
+    else:
+        converter = _builtin.get(cls, _convert)
+    _converters[cls] = converter
+    return converter
+
+def force_unicode(txt):
+    converter = _converters.get(type(txt))
+    if converter is None:
+        converter = _resolve(type(txt))
+    return converter(txt)
+
+# encodings in which ascii text is encoded as itself; output to these can
+# use markup and values that are pure ascii byte strings without conversion
+native_encodings = frozenset(['utf-8', 'ascii'])
+
+_non_ascii = re.compile('[\x80-\xff]').search
+
+def _ascii_str(txt):
+    if _non_ascii(txt) is None:
+        return txt
+    return _decode(txt)
+
+# conversions of exact builtin types to ascii byte strings where possible
+_builtin_text = {
+    str: _ascii_str,
+    int: str,
+    long: str,
+    float: str,
+    bool: str,
+    type(None): str,
+}
+_text_converters = dict(_builtin_text)
+
+def force_text(txt):
+    """
+    Like force_unicode, but returns pure ascii byte strings unchanged and the
+    text of numbers as byte strings, for output to native encodings.
+    """
+    converter = _text_converters.get(type(txt))
+    if converter is None:
+        return force_unicode(txt)
+    return converter(txt)
+
 def compose(*funcs):
     tail = reduce(lambda f1, f2: (lambda v: f1(f2(v))), funcs[:-1])
     return lambda *args, **kwargs: tail(funcs[-1](*args, **kwargs))
@@ -45,10 +145,37 @@ class ListStream(object):
         if self._val is None:
             self._val = ''.join(self.parts)
         return self._val
+    def flush(self):
+        pass
     def close(self):
         self._val = None
         self._parts = []
 
+class ChunkStream(object):
+    """Collects written byte strings until they are taken as a single chunk"""
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+    def write(self, val):
+        self.parts.append(val)
+        self.size += len(val)
+    def flush(self):
+        pass
+    def take(self):
+        chunk = ''.join(self.parts)
+        self.parts = []
+        self.size = 0
+        return chunk
+
+class CountStream(object):
+    """Byte stream that only counts the bytes written to it"""
+    def __init__(self):
+        self.size = 0
+    def write(self, val):
+        self.size += len(val)
+    def flush(self):
+        pass
+
 class StreamWriteEncoder(object):
     """Wrapper around streams that encodes unicode characters before writing them"""
     def __init__(self, stream, encoding=None):
@@ -66,3 +193,104 @@ class StreamWriteEncoder(object):
     def __getattr__(self, attr):
         return getattr(self.stream, attr)
 
+# window bits selecting the container format of each compression method
+_compress_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'zlib': zlib.MAX_WBITS,
+    'deflate': -zlib.MAX_WBITS,
+}
+
+class CompressStream(object):
+    """
+    Wrapper around byte streams that compresses written data on the fly, in
+    gzip, zlib or raw deflate format. Compressed blocks are written to the
+    stream as the compressor produces them; finish writes the rest.
+    """
+    def __init__(self, stream, method='gzip', level=6):
+        if method not in _compress_wbits:
+            raise ValueError("Unknown compression method %r" % method)
+        self.stream = stream
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, _compress_wbits[method])
+
+    def write(self, data):
+        data = self._compressor.compress(data)
+        if data:
+            self.stream.write(data)
+
+    def flush(self):
+        # flushing the compressor here would hurt compression; pending data
+        # is written by finish
+        flush = getattr(self.stream, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def finish(self):
+        self.stream.write(self._compressor.flush())
+        self.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+class DigestStream(object):
+    """Wrapper around byte streams that also feeds written data to a hashlib digest"""
+    def __init__(self, stream, digest):
+        self.stream = stream
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        self.stream.write(data)
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+# number of characters BufferedStreamEncoder collects before encoding them
+DEFAULT_BUFFER_SIZE = 8192
+
+class BufferedStreamEncoder(object):
+    """
+    Like StreamWriteEncoder, but collects written strings until at least
+    buffer_size characters or bytes are pending, and then encodes and writes
+    them as one block. Byte strings are taken to be encoded already. Pending
+    data is only written out by flush, which also flushes the underlying
+    stream.
+    """
+    def __init__(self, stream, encoding=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.stream = stream
+        self.encoding = encoding
+        if not encoding:
+            self.encoding = sys.getfilesystemencoding()
+        self.buffer_size = buffer_size
+        self._parts = []
+        self._type = unicode # type of the pending parts
+        self._size = 0
+
+    def write(self, obj):
+        kind = str if isinstance(obj, str) else unicode
+        if kind is not self._type:
+            self._write_buffer()
+            self._type = kind
+        self._parts.append(obj)
+        self._size += len(obj)
+        if self._size >= self.buffer_size:
+            self._write_buffer()
+
+    def _write_buffer(self):
+        if self._parts:
+            if self._type is str:
+                data = ''.join(self._parts)
+            else:
+                data = u''.join(self._parts).encode(self.encoding)
+            self._parts = []
+            self._size = 0
+            self.stream.write(data)
+
+    def flush(self):
+        self._write_buffer()
+        flush = getattr(self.stream, 'flush', None)
+        if flush is not None:
+            flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
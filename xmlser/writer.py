@@ -0,0 +1,173 @@
+# Copyright 2011 Mark Nevill
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from .ast import Element
+
+# tags in markup emitted as text; values are escaped, so they contain no '>'
+_markup_tag = re.compile(r'<(/?)[^>]*>')
+
+class ElementWriter(object):
+    """
+    Writes elements straight to a unicode stream as handlers emit them.
+
+    Only the start tag of the innermost open element is held back until its
+    first child or its end tag is written, so memory use is bounded by the
+    nesting depth instead of the size of the document. As a consequence,
+    attributes must be emitted before any content of their element.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self._open = []
+        self._pending = False
+
+    def start(self, tag):
+        if self._pending:
+            self.stream.write(u'><' + tag)
+        else:
+            self.stream.write(u'<' + tag)
+        self._open.append(tag)
+        self._pending = True
+
+    def attr(self, name, value):
+        if not self._pending:
+            raise ValueError("XML attribute %r emitted after element content" % name)
+        self.stream.write(u' ' + name + u'="' + value + u'"')
+
+    def text(self, markup):
+        """Write character data or markup, which must already be escaped"""
+        if self._pending:
+            self.stream.write(u'>')
+            self._pending = False
+        self.stream.write(markup)
+
+    def end(self):
+        tag = self._open.pop()
+        if self._pending:
+            self.stream.write(u'></' + tag + u'>')
+            self._pending = False
+        else:
+            self.stream.write(u'</' + tag + u'>')
+
+class TreeWriter(object):
+    """Builds the same element tree as the ast handlers from emitted events"""
+    def __init__(self):
+        self.root = Element(":", [], [])
+        self._open = [self.root]
+
+    def start(self, tag):
+        element = Element(tag, [], [])
+        self._open[-1].content.append(element)
+        self._open.append(element)
+
+    def attr(self, name, value):
+        self._open[-1].attrs.append((name, value))
+
+    def text(self, markup):
+        self._open[-1].content.append(markup)
+
+    def end(self):
+        self._open.pop()
+
+class EncodedWriter(ElementWriter):
+    """
+    ElementWriter writing byte strings in one of utils.native_encodings.
+    Byte strings are taken to be encoded already, so that templates can emit
+    pre-encoded markup; unicode strings are encoded as they are written.
+    """
+    def __init__(self, stream, encoding):
+        ElementWriter.__init__(self, stream)
+        self.encoding = encoding
+
+    def start(self, tag):
+        if isinstance(tag, unicode):
+            tag = tag.encode(self.encoding)
+        if self._pending:
+            self.stream.write('><' + tag)
+        else:
+            self.stream.write('<' + tag)
+        self._open.append(tag)
+        self._pending = True
+
+    def attr(self, name, value):
+        if not self._pending:
+            raise ValueError("XML attribute %r emitted after element content" % name)
+        if isinstance(name, unicode):
+            name = name.encode(self.encoding)
+        if isinstance(value, unicode):
+            value = value.encode(self.encoding)
+        self.stream.write(' ' + name + '="' + value + '"')
+
+    def text(self, markup):
+        if self._pending:
+            self.stream.write('>')
+            self._pending = False
+        if isinstance(markup, unicode):
+            markup = markup.encode(self.encoding)
+        self.stream.write(markup)
+
+    def end(self):
+        tag = self._open.pop()
+        if self._pending:
+            self.stream.write('></' + tag + '>')
+            self._pending = False
+        else:
+            self.stream.write('</' + tag + '>')
+
+class CountingWriter(object):
+    """
+    Counts the elements, attributes and pieces of text emitted, and passes
+    the events on to out. Adjacent text counts as one piece, however it was
+    split up when emitted. Markup emitted as text, such as folded static
+    content, is scanned for the elements, attributes and text it contains.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.elements = self.attributes = self.texts = 0
+        self._in_text = False # whether the last event ended with text
+
+    def start(self, tag):
+        self.elements += 1
+        self._in_text = False
+        self.out.start(tag)
+
+    def attr(self, name, value):
+        self.attributes += 1
+        self.out.attr(name, value)
+
+    def _text(self):
+        if not self._in_text:
+            self.texts += 1
+            self._in_text = True
+
+    def text(self, markup):
+        if '<' in markup:
+            pos = 0
+            for match in _markup_tag.finditer(markup):
+                if match.start() > pos:
+                    self._text()
+                self._in_text = False
+                if not match.group(1):
+                    self.elements += 1
+                    self.attributes += match.group().count('="')
+                pos = match.end()
+            if pos < len(markup):
+                self._text()
+        elif markup:
+            self._text()
+        self.out.text(markup)
+
+    def end(self):
+        self._in_text = False
+        self.out.end()
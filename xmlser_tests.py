@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import xmlser
+import xmlser.ast
 import xmlser.exc
 import unittest
 
@@ -227,5 +228,1040 @@ class SerializationTests(unittest.TestCase):
         self.cmp_ser('<root~?=1<true>~<false>>', '<root<true>>', 1)
         self.cmp_ser('<root~?=1<true>~<false>>', '<root<false>>', 0)
 
+class DirectEmissionTests(unittest.TestCase):
+
+    samples = [
+        ('<root>', None),
+        ('<root<sub*3>>', None),
+        ('<root<sub=attr"test"=other?>>', 'a&b'),
+        ('<root<sub*?&?>>', ['a', u'\xe4', '<b>']),
+        ('<root<.0*?&.1>>', {'a': 1, 'b': 2}),
+        ('<root{.content<item&.0><item&.1>}>', {'content': ['x', 'y']}),
+        ('<root<part*4~?=0&Hello~~?=1&", "~~?=2&World~&"!">>', None),
+        ('<root~??<true=a"1">~<false>>', 0),
+    ]
+
+    def test_same_as_tree(self):
+        for fmt, obj in self.samples:
+            tree = xmlser.make_serializer(fmt)
+            direct = xmlser.make_serializer(fmt, direct=True)
+            self.assertEqual(direct(obj), tree(obj))
+            self.assertEqual(direct(obj, encoding='utf-8'), tree(obj, encoding='utf-8'))
+            self.assertEqual(direct(obj, encoding='utf-8', declaration=True),
+                             tree(obj, encoding='utf-8', declaration=True))
+
+    def test_serialize(self):
+        self.assertEqual(xmlser.serialize('<root<sub&?>>', 'a', direct=True), '<root><sub>a</sub></root>')
+
+    def test_stream(self):
+        from StringIO import StringIO
+        stream = StringIO()
+        ser = xmlser.make_serializer('<root<sub&?>>', direct=True)
+        self.assertEqual(ser(u'\xe4', stream, 'utf-8'), None)
+        self.assertEqual(stream.getvalue(), '<root><sub>\xc3\xa4</sub></root>')
+
+    def test_declaration(self):
+        fmt, body = '<root<sub&?>>', '<root><sub>\xe4</sub></root>'
+        declared = '<?xml version="1.0" encoding="latin1"?>' + body
+        for declaration, exp in [(False, body), (True, declared)]:
+            for direct in (False, True):
+                self.assertEqual(xmlser.serialize(fmt, u'\xe4', encoding='latin1', direct=direct,
+                                                  declaration=declaration), exp)
+            self.assertEqual(''.join(xmlser.iter_serialize(fmt, u'\xe4', 'latin1', declaration=declaration)), exp)
+            self.assertEqual(xmlser.measure(fmt, u'\xe4', 'latin1', declaration=declaration)['size'], len(exp))
+        # unencoded output has no declaration
+        self.assertEqual(xmlser.serialize(fmt, u'\xe4', declaration=True), body.decode('latin1'))
+
+    def test_attr_after_content(self):
+        ser = xmlser.make_serializer('<root&text=attr?>', direct=True)
+        self.assertRaises(ValueError, ser, None)
+
+class CodegenTests(unittest.TestCase):
+
+    samples = DirectEmissionTests.samples + [
+        ('<root~!??<sub>~&"none">', 0),
+        ('<root~?/1<sub>>', [1]),
+        ('<root<a&x&"&"&?&y>>', 'z'),
+        ('<root~?=1{}>', 1),
+    ]
+
+    def test_same_as_ast(self):
+        for fmt, obj in self.samples:
+            ref = xmlser.make_serializer(fmt)
+            for direct in (False, True):
+                ser = xmlser.make_serializer(fmt, direct=direct, backend='codegen')
+                self.assertEqual(ser(obj), ref(obj))
+            self.assertEqual(list(xmlser.iter_serialize(fmt, obj, backend='codegen')),
+                             list(xmlser.iter_serialize(fmt, obj)))
+
+    def test_source(self):
+        from xmlser.compiler import Compiler
+        builder = Compiler('<root<sub*?&.name>>').compile(backend='codegen')
+        self.assertTrue('def emit(obj, out):' in builder.source)
+        self.assertTrue("for o1 in _iterable(obj):" in builder.source)
+        self.assertTrue("_name(o1)" in builder.source)
+
+    def test_render_time_errors(self):
+        ser = xmlser.make_serializer('<root<"1a">>', backend='codegen')
+        self.assertRaises(ValueError, ser, None)
+        ser = xmlser.make_serializer('<root&.attr>', backend='codegen')
+        self.assertRaises(KeyError, ser, {})
+
+    def test_common_lookups(self):
+        class Record(object):
+            accesses = 0
+            @property
+            def content(self):
+                Record.accesses += 1
+                return ['x', 'y']
+        fmt = '<root<a&.content.0><b&.content.1>~.content/z<c&.content.0>~<d&.content.1>>'
+        ser = xmlser.make_serializer(fmt, backend='codegen')
+        self.assertEqual(ser(Record()), '<root><a>x</a><b>y</b><d>y</d></root>')
+        self.assertEqual(Record.accesses, 1)
+        self.assertEqual(ser(Record()), xmlser.make_serializer(fmt)(Record()))
+
+    def test_common_lookups_in_branches(self):
+        # lookups are only evaluated on the paths that reach them
+        fmt = '<root~.a?{<x&.b.c><y&.b.d>}~<z&.e>>'
+        ser = xmlser.make_serializer(fmt, backend='codegen')
+        self.assertEqual(ser({'a': 0, 'e': 1}), '<root><z>1</z></root>')
+        self.assertEqual(ser({'a': 1, 'b': {'c': 2, 'd': 3}}), '<root><x>2</x><y>3</y></root>')
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, xmlser.make_serializer, '<root>', backend='unknown')
+
+class FoldingTests(unittest.TestCase):
+
+    def compile(self, fmt, **opts):
+        from xmlser.compiler import Compiler
+        return Compiler(fmt).compile(**opts)
+
+    def test_static_document(self):
+        builder = self.compile('<doc<header=version"1"<generator&xmlser>><sub*3&"a&b">>')
+        # the root stays a tag around the folded content
+        self.assertTrue(isinstance(builder.handler, xmlser.ast.StaticTag))
+        self.assertEqual([h.markup for h in builder.handler.handlers],
+                         ['<header version="1"><generator>xmlser</generator></header>'
+                          '<sub>a&amp;b</sub><sub>a&amp;b</sub><sub>a&amp;b</sub>'])
+
+    def test_root_element(self):
+        for backend in ('ast', 'codegen'):
+            for fmt in ['<root<a>>', '<root=v"1"&x>', '<root&?>']:
+                folded = self.compile(fmt, backend=backend)(None)
+                unfolded = self.compile(fmt, backend=backend, fold=False)(None)
+                self.assertTrue(type(folded) is type(unfolded) is xmlser.ast.Element)
+                self.assertEqual((folded.tag, folded.attrs), (unfolded.tag, unfolded.attrs))
+
+    def test_partially_static(self):
+        builder = self.compile('<doc=a"1"<static&x><dynamic&?>>')
+        self.assertTrue(isinstance(builder.handler, xmlser.ast.StaticTag))
+        self.assertEqual([type(h) for h in builder.handler.handlers],
+                         [xmlser.ast.StaticAttribute, xmlser.ast.Static, xmlser.ast.StaticTag])
+
+    def test_same_as_unfolded(self):
+        for fmt, obj in CodegenTests.samples + [('<doc<a&x=b"1"><c*2<d>>>', None)]:
+            folded = self.compile(fmt)
+            unfolded = self.compile(fmt, fold=False)
+            self.assertEqual(xmlser.write_document(folded(obj)), xmlser.write_document(unfolded(obj)))
+            self.assertEqual(xmlser.write_document(folded(obj), encoding='utf-8'),
+                             xmlser.write_document(unfolded(obj), encoding='utf-8'))
+
+    def test_invalid_literal(self):
+        builder = self.compile('<root<"1a">>')
+        self.assertTrue(isinstance(builder.handler, xmlser.ast.StaticTag))
+        self.assertRaises(ValueError, builder, None)
+
+class TemplateCacheTests(unittest.TestCase):
+
+    def test_hit(self):
+        from xmlser.cache import TemplateCache
+        cache = TemplateCache()
+        builder = cache.get('<root>')
+        self.assertTrue(cache.get('<root>') is builder)
+        self.assertFalse(cache.get('<root>', backend='codegen') is builder)
+        self.assertEqual(cache.stats(), dict(hits=1, misses=2, evictions=0, size=2, maxsize=256))
+
+    def test_lru(self):
+        from xmlser.cache import TemplateCache
+        cache = TemplateCache(maxsize=2)
+        first = cache.get('<a>')
+        cache.get('<b>')
+        cache.get('<a>')
+        cache.get('<c>')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertTrue(cache.get('<a>') is first)
+        self.assertEqual(cache.misses, 3)
+        cache.get('<b>')
+        self.assertEqual(cache.misses, 4)
+        cache.clear()
+        self.assertEqual(cache.stats(), dict(hits=0, misses=0, evictions=0, size=0, maxsize=2))
+
+    def test_threads(self):
+        import threading
+        from xmlser.cache import TemplateCache
+        cache = TemplateCache(maxsize=5)
+        errors = []
+        def work(n):
+            try:
+                for i in range(200):
+                    fmt = '<root%d&?>' % ((i * n) % 8)
+                    self.assertEqual(xmlser.write_document(cache.get(fmt)(i)),
+                                     '<root%d>%d</root%d>' % ((i * n) % 8, i, (i * n) % 8))
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.hits + cache.misses, 1600)
+
+    def test_serialize(self):
+        from xmlser.cache import templates
+        templates.clear()
+        xmlser.serialize('<root&?>', 1)
+        xmlser.serialize('<root&?>', 2)
+        self.assertEqual((templates.hits, templates.misses), (1, 1))
+
+class DiskCacheTests(unittest.TestCase):
+
+    fmt = '<doc=v"1"<item*?~.0=a&.1~&"other">>'
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        from xmlser.cache import DiskCache
+        obj = [('a', 'x'), ('b', 'y')]
+        for backend in ('ast', 'codegen'):
+            cache = DiskCache(self.directory)
+            self.assertEqual(cache.load(self.fmt, backend=backend), None)
+            builder = cache.get(self.fmt, backend=backend)
+            loaded = DiskCache(self.directory).load(self.fmt, backend=backend)
+            self.assertFalse(loaded is None)
+            self.assertEqual(xmlser.emit_document(loaded, obj), xmlser.emit_document(builder, obj))
+            self.assertEqual(xmlser.write_document(loaded(obj)), xmlser.write_document(builder(obj)))
+        self.assertEqual(DiskCache(self.directory).load(self.fmt, backend='codegen').source, builder.source)
+
+    def test_invalid_files(self):
+        from xmlser.cache import DiskCache
+        cache = DiskCache(self.directory)
+        cache.get(self.fmt)
+        path = cache.path(self.fmt)
+        for data in ['', 'garbage', DiskCache._magic + 'garbage', open(path, 'rb').read()[:-10]]:
+            with open(path, 'wb') as f:
+                f.write(data)
+            self.assertEqual(cache.load(self.fmt), None)
+            self.assertEqual(xmlser.emit_document(cache.get(self.fmt), [('a', 'x')]), '<doc v="1"><item>x</item></doc>')
+            self.assertFalse(cache.load(self.fmt) is None)
+
+    def test_key_mismatch(self):
+        import shutil
+        from xmlser.cache import DiskCache
+        cache = DiskCache(self.directory)
+        cache.get('<a>')
+        shutil.copy(cache.path('<a>'), cache.path('<b>'))
+        self.assertEqual(cache.load('<b>'), None)
+        self.assertEqual(xmlser.write_document(cache.get('<b>')(None)), '<b></b>')
+
+    def test_sources_changed(self):
+        from xmlser import cache
+        disk = cache.DiskCache(self.directory)
+        disk.get(self.fmt)
+        sources = cache.sources_digest()
+        cache._sources = 'changed'
+        try:
+            self.assertEqual(disk.load(self.fmt), None)
+        finally:
+            cache._sources = sources
+        self.assertFalse(disk.load(self.fmt) is None)
+
+    def test_stale_layout(self):
+        from xmlser import ast
+        from xmlser.cache import DiskCache
+        cache = DiskCache(self.directory)
+        fmt = '<doc<item*.items[1:]&?>>'
+        for backend in ('ast', 'codegen'):
+            builder = cache.get(fmt, backend=backend)
+            root = builder.root if backend == 'codegen' else builder
+            replist = root.handler.handlers[0].replist
+            self.assertTrue(isinstance(replist, ast.List))
+            # a list pickled before windows were added
+            del replist.bounds
+            cache.store(fmt, builder, backend=backend)
+            self.assertEqual(cache.load(fmt, backend=backend), None)
+            self.assertEqual(xmlser.emit_document(cache.get(fmt, backend=backend), dict(items='abc')),
+                             '<doc><item>b</item><item>c</item></doc>')
+
+    def test_unusable_directory(self):
+        import os
+        from xmlser.cache import DiskCache, TemplateCache
+        path = os.path.join(self.directory, 'file')
+        open(path, 'wb').close()
+        for directory in (path, os.path.join(path, 'sub')):
+            cache = DiskCache(directory)
+            self.assertEqual(cache.load(self.fmt), None)
+            self.assertEqual(xmlser.emit_document(cache.get(self.fmt), [('a', 'x')]), '<doc v="1"><item>x</item></doc>')
+            templates = TemplateCache(disk=cache)
+            self.assertEqual(xmlser.write_document(templates.get('<r&?>')(1)), '<r>1</r>')
+
+    def test_template_cache(self):
+        from xmlser.cache import DiskCache, TemplateCache
+        TemplateCache(disk=DiskCache(self.directory)).get(self.fmt)
+        self.assertFalse(DiskCache(self.directory).load(self.fmt) is None)
+
+class KeyLookupTests(unittest.TestCase):
+
+    def test_strategies(self):
+        import collections
+        from xmlser.ast import KeyLookup
+        Point = collections.namedtuple('Point', 'x y')
+        lookup = KeyLookup('x')
+        for i in range(3):
+            self.assertEqual(lookup(Point(i, 0)), i)
+            self.assertEqual(lookup({'x': i}), i)
+        self.assertEqual(lookup._strategies, {Point: lookup._attr, dict: lookup._item})
+        self.assertRaises(KeyError, lookup, {})
+        self.assertRaises(AttributeError, lookup, 1)
+
+    def test_int_keys(self):
+        from xmlser.ast import KeyLookup
+        lookup = KeyLookup(0)
+        for obj, value in [({'0': 'a'}, 'a'), ({0: 'b', '0': 'c'}, 'b'), ({'0': 'd'}, 'd'), (['e'], 'e'), ('f', 'f')]:
+            self.assertEqual(lookup(obj), value)
+        self.assertRaises(KeyError, lookup, [])
+        self.assertRaises(KeyError, lookup, {})
+
+    def test_pickle(self):
+        import cPickle
+        from xmlser.ast import AttrLookup
+        lookup = AttrLookup(['a', 0])
+        self.assertEqual(lookup({'a': [1]}), 1)
+        lookup = cPickle.loads(cPickle.dumps(lookup, 2))
+        self.assertEqual(lookup.keys, ['a', 0])
+        self.assertEqual(lookup({'a': [1]}), 1)
+
+    def test_non_ascii_keys(self):
+        obj = {'\xc3\xa4': 1, 'a-b': 3}
+        for backend in ('ast', 'codegen'):
+            self.assertEqual(xmlser.serialize('<r&."\xc3\xa4"&."a-b">', obj, backend=backend), '<r>13</r>')
+
+class DispatchTests(unittest.TestCase):
+
+    fmt = '<root<item*?~.0=a&A~~.0=b<b&.1>~~.0=1&one~~.0=a&again~&.1>>'
+
+    def test_compiled(self):
+        from xmlser.compiler import Compiler
+        builder = Compiler(self.fmt).compile()
+        dispatch = builder.handler.handlers[0].handler.handlers[0]
+        self.assertTrue(isinstance(dispatch, xmlser.ast.Dispatch))
+        self.assertEqual([literal for literal, handler in dispatch.branches], ['a', 'b', 1, 'a'])
+        self.assertFalse(isinstance(Compiler('<root~?=a&A~~?=b&B>').compile().handler.handlers[0],
+                                    xmlser.ast.Dispatch))
+
+    def test_same_as_chain(self):
+        class Name(object):
+            def __eq__(self, other):
+                return other == 'b'
+        objs = [[('a', 1), ('b', 2), (1, 3), ('c', 4), (u'b', 5), (1.0, 6), (Name(), 7), ([], 8)]]
+        from xmlser.compiler import Compiler
+        chain = Compiler(self.fmt).compile(dispatch=False)
+        for backend in ('ast', 'codegen'):
+            builder = Compiler(self.fmt).compile(backend=backend)
+            for obj in objs:
+                self.assertEqual(xmlser.write_document(builder(obj)), xmlser.write_document(chain(obj)))
+                self.assertEqual(xmlser.emit_document(builder, obj), xmlser.write_document(chain(obj)))
+
+    def test_lhs_evaluated_once(self):
+        class Item(object):
+            lookups = 0
+            @property
+            def kind(self):
+                Item.lookups += 1
+                return 'z'
+        ser = xmlser.make_serializer('<root~.kind=a&A~~.kind=b&B~~.kind=c&C~&other>')
+        self.assertEqual(ser(Item()), '<root>other</root>')
+        self.assertEqual(Item.lookups, 1)
+
+class EscapeTests(unittest.TestCase):
+
+    def test_text(self):
+        from xmlser.escape import escape_text
+        plain = u'nothing to see here'
+        self.assertTrue(escape_text(plain) is plain)
+        self.assertEqual(escape_text(u'a&b<c>d"e\n'), u'a&amp;b&lt;c&gt;d"e\n')
+        self.assertEqual(escape_text(u'&amp;'), u'&amp;amp;')
+
+    def test_attr(self):
+        from xmlser.escape import escape_attr
+        plain = u'nothing to see here'
+        self.assertTrue(escape_attr(plain) is plain)
+        self.assertEqual(escape_attr(u'a&b<c>d"e\tf\ng\rh'), u'a&amp;b&lt;c&gt;d&quot;e&#9;f&#10;g&#13;h')
+
+    def test_serialize(self):
+        fmt = '<root=a?=b"x\\"y"&?>'
+        exp = '<root a="&lt;&quot;&#10;" b="x&quot;y">&lt;"\n</root>'
+        for backend in ('ast', 'codegen'):
+            for direct in (False, True):
+                self.assertEqual(xmlser.serialize(fmt, '<"\n', direct=direct, backend=backend), exp)
+
+class MemoTests(unittest.TestCase):
+
+    def test_memo(self):
+        from xmlser.escape import Memo, escape_text
+        memo = Memo(escape_text, field='&.code')
+        for value, exp in [('a&b', 'a&amp;b'), ('a&b', 'a&amp;b'), (1, '1'), (True, 'True'),
+                           (1.0, '1.0'), (u'a&b', 'a&amp;b'), (1, '1')]:
+            self.assertEqual(memo(value), exp)
+        self.assertEqual(memo.stats(), dict(field='&.code', hits=3, misses=4, evictions=0, size=4))
+
+    def test_bounded(self):
+        from xmlser.escape import Memo, escape_text
+        memo = Memo(escape_text, maxsize=2)
+        for i in range(5):
+            self.assertEqual(memo(i), str(i))
+        self.assertEqual((memo.misses, memo.evictions, len(memo.values)), (5, 3, 2))
+
+    def test_equal_values(self):
+        import datetime, decimal
+        class Offset(datetime.tzinfo):
+            def __init__(self, hours):
+                self.hours = hours
+            def utcoffset(self, dt):
+                return datetime.timedelta(hours=self.hours)
+        values = [decimal.Decimal('1.0'), decimal.Decimal('1.00'), 0.0, -0.0,
+                  datetime.datetime(2011, 5, 1, 12, tzinfo=Offset(0)),
+                  datetime.datetime(2011, 5, 1, 13, tzinfo=Offset(1)),
+                  datetime.time(12, tzinfo=Offset(0)), datetime.time(13, tzinfo=Offset(1))]
+        for backend in ('ast', 'codegen'):
+            self.assertEqual(xmlser.serialize('<r<v*?&?>>', values, memoize=16, backend=backend),
+                             xmlser.serialize('<r<v*?&?>>', values, backend=backend))
+        self.assertTrue('<v>1.00</v><v>0.0</v><v>-0.0</v>' in xmlser.serialize('<r<v*?&?>>', values, memoize=16))
+
+    def test_mutable_objects(self):
+        from xmlser.escape import Memo, escape_text
+        class Obj(object):
+            text = 'a'
+            def __str__(self):
+                return self.text
+        obj = Obj()
+        memo = Memo(escape_text)
+        self.assertEqual(memo(obj), 'a')
+        obj.text = 'b'
+        self.assertEqual(memo(obj), 'b')
+        self.assertEqual(memo([1]), '[1]')
+
+    def test_template(self):
+        fmt = '<root<item*?=status.status&.country>>'
+        items = [dict(status=s, country=c) for s in ('ok', 'failed') for c in ('CH', 'DE', 'JP')] * 10
+        for backend in ('ast', 'codegen'):
+            ser = xmlser.make_serializer(fmt, backend=backend, memoize=10)
+            self.assertEqual(ser(items), xmlser.serialize(fmt, items))
+            from xmlser.compiler import Compiler
+            builder = Compiler(fmt).compile(backend=backend, memoize=10)
+            xmlser.emit_document(builder, items)
+            stats = dict((s['field'], (s['hits'], s['misses'])) for s in builder.memo_stats())
+            self.assertEqual(stats, {'=status.status': (58, 2), '&.country': (57, 3)})
+
+class BufferedStreamEncoderTests(unittest.TestCase):
+
+    class Stream(object):
+        def __init__(self):
+            self.writes = []
+            self.flushes = 0
+        def write(self, data):
+            self.writes.append(data)
+        def flush(self):
+            self.flushes += 1
+
+    def test_buffering(self):
+        from xmlser.utils import BufferedStreamEncoder
+        stream = self.Stream()
+        encoder = BufferedStreamEncoder(stream, 'utf-8', buffer_size=4)
+        encoder.write(u'ab')
+        encoder.write(u'\xe4')
+        self.assertEqual(stream.writes, [])
+        encoder.write(u'c')
+        self.assertEqual(stream.writes, ['ab\xc3\xa4c'])
+        encoder.write(u'd')
+        encoder.write('raw')
+        encoder.write(u'e')
+        encoder.flush()
+        self.assertEqual(stream.writes, ['ab\xc3\xa4c', 'd', 'raw', 'e'])
+        self.assertEqual(stream.flushes, 1)
+
+    def test_write_document(self):
+        items = ['item%d' % i for i in range(1000)]
+        for direct in (False, True):
+            stream = self.Stream()
+            xmlser.serialize('<root<sub*?&?>>', items, stream, 'utf-8', direct=direct)
+            self.assertEqual(''.join(stream.writes),
+                             xmlser.serialize('<root<sub*?&?>>', items, encoding='utf-8', direct=direct))
+            self.assertTrue(len(stream.writes) < 10)
+            self.assertEqual(stream.flushes, 1)
+
+class EncodedOutputTests(unittest.TestCase):
+
+    fmt = '<root=id.id<item*.items=n?&"caf\xc3\xa9 "&?>>'
+    obj = dict(id=7, items=['plain', u'\xe4<', 3, 1.5, 'caf\xc3\xa9'])
+
+    def test_force_text(self):
+        from xmlser.utils import force_text
+        plain = 'plain'
+        self.assertTrue(force_text(plain) is plain)
+        self.assertEqual(force_text(12), '12')
+        self.assertEqual(force_text(None), 'None')
+        self.assertEqual(force_text('caf\xc3\xa9'), u'caf\xe9')
+        self.assertEqual(force_text(u'x'), u'x')
+
+    def test_source(self):
+        from xmlser.compiler import Compiler
+        builder = Compiler(self.fmt).compile(backend='codegen')
+        emit, iter_emit = builder.encoded('UTF8')
+        self.assertTrue(builder.encoded('utf-8')[0] is emit)
+        self.assertTrue('caf\xc3\xa9 ' in emit.func_code.co_consts)
+        self.assertTrue(u'caf\xe9 ' in builder.emit.func_code.co_consts)
+
+    def test_same_output(self):
+        for encoding in ('utf-8', 'ascii', 'latin1'):
+            exp = xmlser.serialize(self.fmt, self.obj, encoding=encoding, direct=True) if encoding != 'ascii' else None
+            for direct in (False, True):
+                ser = xmlser.make_serializer(self.fmt, direct=direct, backend='codegen')
+                if exp is None:
+                    self.assertRaises(UnicodeEncodeError, ser, self.obj, encoding=encoding)
+                else:
+                    self.assertEqual(ser(self.obj, encoding=encoding), exp)
+                    self.assertEqual(''.join(ser.iter(self.obj, encoding, chunk_size=16)), exp)
+        self.assertEqual(xmlser.serialize('<root&?>', 'a<b', encoding='ascii', direct=True, backend='codegen'),
+                         '<root>a&lt;b</root>')
+
+    def test_writes_bytes(self):
+        from xmlser import utils, writer
+        from xmlser.compiler import Compiler
+        class Stream(list):
+            def write(self, data):
+                self.append(data)
+        stream = Stream()
+        emit, _ = Compiler(self.fmt).compile(backend='codegen').encoded('utf-8')
+        emit(self.obj, writer.EncodedWriter(stream, 'utf-8'))
+        self.assertTrue(all(type(data) is str for data in stream))
+        self.assertEqual(''.join(stream), xmlser.serialize(self.fmt, self.obj).encode('utf-8'))
+
+class ForceUnicodeTests(unittest.TestCase):
+
+    def test_builtin_types(self):
+        import datetime, decimal
+        from xmlser.utils import force_unicode
+        text = u'text'
+        self.assertTrue(force_unicode(text) is text)
+        for value in [1, 2L**70, 1.5, True, False, None, decimal.Decimal('1.50'),
+                      datetime.date(2011, 5, 1), datetime.datetime(2011, 5, 1, 12, 30),
+                      datetime.time(12, 30)]:
+            self.assertEqual(force_unicode(value), unicode(value))
+            self.assertTrue(type(force_unicode(value)) is unicode)
+
+    def test_str(self):
+        from xmlser import utils
+        self.assertEqual(utils.force_unicode('caf\xc3\xa9'), u'caf\xe9')
+        self.assertEqual(utils.force_unicode('caf\xe9'), u'caf\xe9')
+        utils.str_encoding = 'cp1252'
+        try:
+            self.assertEqual(utils.force_unicode('\x80'), u'\u20ac')
+        finally:
+            utils.str_encoding = 'utf-8'
+
+    def test_other_types(self):
+        from xmlser.utils import force_unicode
+        class Obj(object):
+            def __str__(self):
+                return 'caf\xc3\xa9'
+        class Int(int):
+            pass
+        self.assertEqual(force_unicode(Obj()), u'caf\xe9')
+        self.assertEqual(force_unicode(Int(3)), u'3')
+        self.assertEqual(force_unicode([1]), u'[1]')
+
+    def test_register_converter(self):
+        from xmlser import utils
+        class Money(object):
+            def __init__(self, cents):
+                self.cents = cents
+        class Euros(Money):
+            pass
+        self.assertTrue(utils.force_unicode(Euros(150)).startswith(u'<'))
+        utils.register_converter(Money, lambda m: u'%d.%02d' % divmod(m.cents, 100))
+        try:
+            self.assertEqual(utils.force_unicode(Money(150)), u'1.50')
+            self.assertEqual(utils.force_unicode(Euros(5)), u'0.05')
+            self.assertEqual(xmlser.serialize('<price&?>', Euros(1999)), '<price>19.99</price>')
+        finally:
+            del utils._registered[Money]
+            utils._reset()
+
+    def test_register_builtin(self):
+        import datetime
+        from xmlser import utils
+        utils.register_converter(float, lambda f: u'%.2f' % f)
+        utils.register_converter(datetime.date, lambda d: d.strftime('%d.%m.%Y'))
+        try:
+            self.assertEqual(utils.force_unicode(1.5), u'1.50')
+            self.assertEqual(utils.force_text(1.5), u'1.50')
+            self.assertEqual(utils.force_unicode(datetime.datetime(2011, 5, 1, 12)), u'01.05.2011')
+            obj = dict(price=1.5, date=datetime.date(2011, 5, 1))
+            for backend in ('ast', 'codegen'):
+                for encoding in (None, 'utf-8'):
+                    self.assertEqual(xmlser.serialize('<p=d.date&.price>', obj, backend=backend,
+                                                      direct=True, encoding=encoding),
+                                     '<p d="01.05.2011">1.50</p>')
+        finally:
+            del utils._registered[float]
+            del utils._registered[datetime.date]
+            utils._reset()
+        self.assertEqual(utils.force_unicode(1.5), u'1.5')
+        self.assertEqual(utils.force_text(1.5), '1.5')
+
+class LazyTests(unittest.TestCase):
+
+    def test_lazy(self):
+        fmt = '<root~.full?<details&.details.text&.details.more>~&.summary>'
+        for backend in ('ast', 'codegen'):
+            calls = []
+            def details(text):
+                calls.append(text)
+                return dict(text=text, more=xmlser.lazy(lambda: '!'))
+            objs = [dict(full=i % 2, summary='s%d' % i, details=xmlser.lazy(details, 'd%d' % i)) for i in range(4)]
+            out = [xmlser.serialize(fmt, obj, backend=backend) for obj in objs]
+            self.assertEqual(out, ['<root>s0</root>', '<root><details>d1!</details></root>',
+                                   '<root>s2</root>', '<root><details>d3!</details></root>'])
+            self.assertEqual(calls, ['d1', 'd3'])
+            xmlser.serialize(fmt, objs[1], backend=backend)
+            self.assertEqual(calls, ['d1', 'd3'])
+
+    def test_lazy_source(self):
+        self.assertEqual(xmlser.serialize('<root<item*.items&?>>', dict(items=xmlser.lazy(range, 3))),
+                         '<root><item>0</item><item>1</item><item>2</item></root>')
+
+    def test_lazy_items(self):
+        items = [xmlser.lazy(lambda i=i: dict(name='n%d' % i)) for i in range(3)]
+        for backend in ('ast', 'codegen'):
+            for direct in (False, True):
+                self.assertEqual(xmlser.serialize('<r<i*.items&.name>>', dict(items=items),
+                                                  backend=backend, direct=direct),
+                                 '<r><i>n0</i><i>n1</i><i>n2</i></r>')
+                self.assertEqual(xmlser.serialize('<r<i*.items&?>>', dict(items=[xmlser.lazy(str, 1)]),
+                                                  backend=backend, direct=direct),
+                                 '<r><i>1</i></r>')
+
+    def test_lazy_root(self):
+        for backend in ('ast', 'codegen'):
+            self.assertEqual(xmlser.serialize('<r&?>', xmlser.lazy(lambda: 'x'), backend=backend), '<r>x</r>')
+            self.assertEqual(xmlser.serialize('<r&.a>', xmlser.lazy(dict, a=1), backend=backend), '<r>1</r>')
+            self.assertEqual(xmlser.serialize('<r<i*.items[.start:]&?>>',
+                                              dict(items='abc', start=xmlser.lazy(int, '1')), backend=backend),
+                             '<r><i>b</i><i>c</i></r>')
+
+    def test_lazy_race(self):
+        calls = []
+        value = xmlser.lazy(lambda: calls.append(1) or len(calls))
+        first = value.get()
+        # a lookup that passed the check before the value was stored
+        value._value = value._unset
+        self.assertEqual(value.get(), 2)
+        self.assertEqual((first, value.get()), (1, 2))
+
+class DependencyTests(unittest.TestCase):
+
+    def test_dependencies(self):
+        from xmlser.compiler import Compiler
+        fmt = '<orders=date.meta.date<order*.orders=id.id~.paid?<paid&.payment.amount>~<open>' \
+              '{.customer<name&.name>}>~.meta.notes?<notes&.meta.notes>>'
+        for backend in ('ast', 'codegen'):
+            deps = Compiler(fmt).compile(backend=backend).dependencies()
+            flags = dict((path, (node.rendered, node.tested, node.iterated, node.optional))
+                         for path, node in deps.walk())
+            self.assertEqual(flags, {
+                (): (False, False, False, False),
+                ('meta',): (False, False, False, False),
+                ('meta', 'date'): (True, False, False, False),
+                ('meta', 'notes'): (True, True, False, False),
+                ('orders',): (False, False, True, False),
+                ('orders', '*'): (False, False, False, False),
+                ('orders', '*', 'id'): (True, False, False, False),
+                ('orders', '*', 'paid'): (False, True, False, False),
+                ('orders', '*', 'payment'): (False, False, False, True),
+                ('orders', '*', 'payment', 'amount'): (True, False, False, True),
+                ('orders', '*', 'customer'): (False, False, False, False),
+                ('orders', '*', 'customer', 'name'): (True, False, False, False),
+            })
+
+    def test_dispatch(self):
+        deps = xmlser.compiler.Compiler('<r~.k=a&.a~~.k=b&.b~~.k=c&.c~&.d>').compile().dependencies()
+        self.assertEqual([(path, node.optional) for path, node in deps.walk()],
+                         [((), False), (('k',), False), (('a',), True), (('b',), True),
+                          (('c',), True), (('d',), True)])
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        from xmlser.batch import BatchAttribute
+        customers = dict((i, dict(name='customer%d' % i)) for i in range(10))
+        self.calls = calls = []
+        def load_customers(orders):
+            calls.append(len(orders))
+            return [customers[order.customer_id] for order in orders]
+        class Order(object):
+            customer = BatchAttribute(load_customers)
+            def __init__(self, id):
+                self.id, self.customer_id = id, id % 10
+        self.Order = Order
+        self.fmt = '<orders<order*?=id.id&.customer.name>>'
+        self.exp = xmlser.serialize(self.fmt, [dict(id=i, customer=customers[i % 10]) for i in range(25)])
+
+    def test_batched(self):
+        from xmlser.batch import batched
+        for backend in ('ast', 'codegen'):
+            del self.calls[:]
+            orders = [self.Order(i) for i in range(25)]
+            self.assertEqual(xmlser.serialize(self.fmt, batched(orders, 10), backend=backend), self.exp)
+            self.assertEqual(self.calls, [10, 10, 5])
+
+    def test_unbatched(self):
+        orders = [self.Order(i) for i in range(25)]
+        self.assertEqual(xmlser.serialize(self.fmt, orders), self.exp)
+        self.assertEqual(self.calls, [1] * 25)
+        self.assertEqual(xmlser.serialize(self.fmt, orders), self.exp)
+        self.assertEqual(len(self.calls), 25)
+
+    def test_iter(self):
+        from xmlser.batch import batched, _windows
+        orders = [self.Order(i) for i in range(25)]
+        chunks = xmlser.iter_serialize(self.fmt, batched(orders, 10), chunk_size=16)
+        next(chunks)
+        self.assertEqual(self.calls, [10])
+        chunks.close()
+        self.assertEqual(_windows(), [])
+
+class SerializeManyTests(unittest.TestCase):
+
+    records = [dict(id=i, name=u'n\xe4me<%d>' % i) for i in range(5)]
+
+    def test_many(self):
+        fmt = '<record=id.id&.name>'
+        single = ''.join(xmlser.serialize(fmt, r, direct=True) for r in self.records)
+        for backend in ('ast', 'codegen'):
+            self.assertEqual(xmlser.serialize_many(fmt, self.records, backend=backend), single)
+            self.assertEqual(xmlser.serialize_many(fmt, self.records, encoding='utf-8', backend=backend),
+                             single.encode('utf-8'))
+            self.assertEqual(xmlser.serialize_many(fmt, iter(self.records), root='export', encoding='utf-8',
+                                                   backend=backend, declaration=True),
+                             '<?xml version="1.0" encoding="utf-8"?><export>%s</export>' % single.encode('utf-8'))
+
+    def test_stream(self):
+        from StringIO import StringIO
+        stream = StringIO()
+        ser = xmlser.make_serializer('<a&.id><b&.name>', single_root=False)
+        self.assertEqual(ser.many(self.records[:2], stream, 'utf-8', root='rows'), None)
+        self.assertEqual(stream.getvalue(), '<rows>'
+                         '<a>0</a><b>n\xc3\xa4me&lt;0&gt;</b><a>1</a><b>n\xc3\xa4me&lt;1&gt;</b></rows>')
+
+    def test_empty(self):
+        self.assertEqual(xmlser.serialize_many('<r>', [], root='rows'), '<rows></rows>')
+        self.assertEqual(xmlser.serialize_many('<r>', []), '')
+        self.assertRaises(ValueError, xmlser.serialize_many, '<r>', [], root='1x')
+
+class CompressionTests(unittest.TestCase):
+
+    fmt = '<root<item*?=n?&?>>'
+    items = [u'item \xe4 %d' % (i % 50) for i in range(2000)]
+
+    def decompress(self, data, method):
+        import zlib
+        wbits = {'gzip': 16 + zlib.MAX_WBITS, 'zlib': zlib.MAX_WBITS, 'deflate': -zlib.MAX_WBITS}[method]
+        return zlib.decompress(data, wbits)
+
+    def test_serialize(self):
+        for method in ('gzip', 'zlib', 'deflate'):
+            for direct in (False, True):
+                exp = xmlser.serialize(self.fmt, self.items, encoding='utf-8', direct=direct)
+                data = xmlser.serialize(self.fmt, self.items, direct=direct, compress=method)
+                self.assertTrue(len(data) < len(exp) / 10)
+                self.assertEqual(self.decompress(data, method), exp)
+            data = xmlser.serialize(self.fmt, self.items, encoding='latin1', compress=method, level=1)
+            self.assertEqual(self.decompress(data, method), xmlser.serialize(self.fmt, self.items, encoding='latin1'))
+
+    def test_gzip_file(self):
+        import gzip
+        from StringIO import StringIO
+        stream = StringIO()
+        ser = xmlser.make_serializer(self.fmt, direct=True)
+        ser(self.items, stream, 'utf-8', compress='gzip')
+        stream.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=stream).read(), ser(self.items, encoding='utf-8'))
+
+    def test_chunks(self):
+        import hashlib
+        items = [hashlib.md5(str(i)).hexdigest() for i in range(2000)]
+        chunks = list(xmlser.iter_serialize(self.fmt, items, chunk_size=256, compress='zlib'))
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(self.decompress(''.join(chunks), 'zlib'),
+                         xmlser.serialize(self.fmt, items, encoding='utf-8', direct=True))
+        rows = [dict(id=i) for i in range(100)]
+        data = xmlser.serialize_many('<row=id.id>', rows, root='rows', compress='deflate')
+        self.assertEqual(self.decompress(data, 'deflate'), xmlser.serialize_many('<row=id.id>', rows, root='rows', encoding='utf-8'))
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, xmlser.serialize, self.fmt, [], compress='lzma')
+
+class DigestTests(unittest.TestCase):
+
+    fmt = '<root<item*?&?>>'
+    items = [u'item \xe4 %d' % i for i in range(500)]
+
+    def test_digest(self):
+        import hashlib
+        from StringIO import StringIO
+        for direct in (False, True):
+            digest = hashlib.sha1()
+            data = xmlser.serialize(self.fmt, self.items, direct=direct, digest=digest)
+            self.assertEqual(data, xmlser.serialize(self.fmt, self.items, encoding='utf-8', direct=direct))
+            self.assertEqual(digest.hexdigest(), hashlib.sha1(data).hexdigest())
+
+            stream = StringIO()
+            digest = hashlib.md5()
+            xmlser.serialize(self.fmt, self.items, stream, 'latin1', direct=direct, compress='gzip', digest=digest)
+            self.assertEqual(digest.hexdigest(), hashlib.md5(stream.getvalue()).hexdigest())
+
+    def test_chunks(self):
+        import hashlib
+        digest = hashlib.sha256()
+        chunks = xmlser.make_serializer(self.fmt).iter(self.items, chunk_size=100, digest=digest)
+        data = ''.join(chunks)
+        self.assertEqual(digest.hexdigest(), hashlib.sha256(data).hexdigest())
+
+class MeasureTests(unittest.TestCase):
+
+    fmt = '<root=v"1"<static=a"1"=b"&quot;"<x&"t">&"u"><item*?=id?&?<sub&"s">>&"end">'
+    items = [u'it\xe9m <%d>' % i for i in range(20)]
+
+    def test_measure(self):
+        for backend in ('ast', 'codegen'):
+            for fold in (False, True):
+                for encoding in ('utf-8', 'utf-16', 'latin1'):
+                    stats = xmlser.measure(self.fmt, self.items, encoding, backend=backend, fold=fold)
+                    data = xmlser.serialize(self.fmt, self.items, encoding=encoding, direct=True)
+                    self.assertEqual(stats, dict(size=len(data), elements=43, attributes=23, texts=43))
+                # adjacent texts are one piece, whether folded or not
+                stats = xmlser.measure('<r&a&b&?<s>&"c"&?>', 'x', backend=backend, fold=fold)
+                self.assertEqual((stats['elements'], stats['texts']), (2, 2))
+
+    def test_compressed(self):
+        ser = xmlser.make_serializer(self.fmt, direct=True)
+        self.assertEqual(ser.measure(self.items, compress='gzip')['size'],
+                         len(ser(self.items, encoding='utf-8', compress='gzip')))
+
+class ShardTests(unittest.TestCase):
+
+    fmt = '<feed=n.name<title&.name><entry*.entries=id.id&.text><footer&"end">>'
+    obj = dict(name='f', entries=[dict(id=i, text=u'\xe4' * (i % 7)) for i in range(25)])
+
+    class Stream(object):
+        def __init__(self, shards):
+            self.data = []
+            self.closed = False
+            shards.append(self)
+        def write(self, data):
+            self.data.append(data)
+        def close(self):
+            self.closed = True
+            self.value = ''.join(self.data)
+
+    def shards(self, fmt, obj, **options):
+        shards = []
+        stats = xmlser.write_shards(fmt, obj, lambda i: self.Stream(shards), **options)
+        self.assertTrue(all(s.closed for s in shards))
+        self.assertEqual([len(s.value) for s in shards], [size for count, size in stats])
+        return [s.value for s in shards], [count for count, size in stats]
+
+    def expected(self, entries):
+        return xmlser.serialize(self.fmt, dict(self.obj, entries=entries), encoding='utf-8', direct=True)
+
+    def test_items(self):
+        for backend in ('ast', 'codegen'):
+            shards, counts = self.shards(self.fmt, self.obj, max_items=10, backend=backend)
+            self.assertEqual(counts, [10, 10, 5])
+            entries = self.obj['entries']
+            self.assertEqual(shards, [self.expected(entries[:10]), self.expected(entries[10:20]),
+                                      self.expected(entries[20:])])
+
+    def test_bytes(self):
+        limit = 400
+        shards, counts = self.shards(self.fmt, self.obj, max_bytes=limit)
+        self.assertTrue(len(shards) > 1)
+        self.assertTrue(all(len(s) <= limit for s in shards))
+        start = 0
+        for shard, count in zip(shards, counts):
+            self.assertEqual(shard, self.expected(self.obj['entries'][start:start + count]))
+            start += count
+        self.assertEqual(start, 25)
+
+    def test_oversized_and_empty(self):
+        shards, counts = self.shards(self.fmt, self.obj, max_bytes=10)
+        self.assertEqual(counts, [1] * 25)
+        shards, counts = self.shards(self.fmt, dict(self.obj, entries=[]), max_items=10)
+        self.assertEqual((shards, counts), ([self.expected([])], [0]))
+
+    def test_compiler_and_reuse(self):
+        from xmlser.compiler import Compiler
+        from xmlser.shard import ShardWriter
+        writer = ShardWriter(Compiler(self.fmt), max_items=20)
+        for entries in (self.obj['entries'], self.obj['entries'][:5]):
+            shards = []
+            writer.write(dict(self.obj, entries=entries), lambda i: self.Stream(shards))
+            self.assertEqual([s.value for s in shards],
+                             [self.expected(entries[i:i + 20]) for i in range(0, len(entries), 20)])
+
+    def test_declaration(self):
+        shards, counts = self.shards(self.fmt, self.obj, max_items=20, declaration=True)
+        entries = self.obj['entries']
+        self.assertEqual(shards, [xmlser.serialize(self.fmt, dict(self.obj, entries=entries[i:i + 20]),
+                                                   encoding='utf-8', declaration=True) for i in (0, 20)])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, xmlser.write_shards, '<feed>', None, None, max_items=1)
+        self.assertRaises(ValueError, xmlser.write_shards, self.fmt, self.obj, None)
+
+class IterWriteTests(unittest.TestCase):
+
+    class Sink(object):
+        def __init__(self):
+            self.chunks = []
+            self.drained = 0
+        def write(self, data):
+            self.chunks.append(data)
+        def drain(self):
+            self.drained += 1
+            return self.drained
+
+    def test_drain(self):
+        pulled = []
+        def source():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+        sink = self.Sink()
+        steps = xmlser.iter_write('<root<item*?&?>>', source(), sink, chunk_size=64)
+        self.assertEqual(next(steps), 1)
+        self.assertEqual(len(sink.chunks), 1)
+        self.assertTrue(len(pulled) < 100)
+        self.assertEqual(list(steps), range(2, sink.drained + 1))
+        self.assertEqual(''.join(sink.chunks),
+                         xmlser.serialize('<root<item*?&?>>', range(100), encoding='utf-8', direct=True))
+
+    def test_plain_sink(self):
+        from StringIO import StringIO
+        sink = StringIO()
+        ser = xmlser.make_serializer('<root<item*?&?>>', direct=True)
+        self.assertEqual(set(ser.iter_write(range(10), sink, chunk_size=16)), set([None]))
+        self.assertEqual(sink.getvalue(), ser(range(10), encoding='utf-8'))
+
+class ParallelTests(unittest.TestCase):
+
+    fmt = '<root=n.name<item*.items=id.id<tag*.tags&?>><id*.items&.id><tail&.name>>'
+    obj = dict(name='x', items=[dict(id=i, tags=['t%d' % i, u'\xe4<']) for i in range(50)])
+
+    def test_sites(self):
+        from xmlser import parallel
+        ser = parallel.ParallelRenderer(self.fmt, 1)
+        try:
+            self.assertEqual(len(ser.sites), 2)
+        finally:
+            ser.close()
+
+    def test_same_output(self):
+        for backend in ('ast', 'codegen'):
+            for direct in (False, True):
+                ser = xmlser.make_serializer(self.fmt, direct=direct, backend=backend)
+                par = xmlser.make_serializer(self.fmt, direct=direct, workers=2, batch_size=7, backend=backend)
+                try:
+                    self.assertEqual(par(self.obj), ser(self.obj))
+                    self.assertEqual(par(self.obj, encoding='utf-8'), ser(self.obj, encoding='utf-8'))
+                    self.assertEqual(''.join(par.iter(self.obj)), ''.join(ser.iter(self.obj)))
+                finally:
+                    par.close()
+
+    def test_errors(self):
+        ser = xmlser.make_serializer('<root<item*?&.missing>>', workers=2, batch_size=2)
+        try:
+            self.assertRaises(KeyError, ser, [{}] * 5)
+        finally:
+            ser.close()
+
+class WindowTests(unittest.TestCase):
+
+    def test_windows(self):
+        items = range(20)
+        for window, exp in [('[5:8]', items[5:8]), ('[:3]', items[:3]), ('[15:]', items[15:]),
+                            ('[::7]', items[::7]), ('[2:12:4]', items[2:12:4]),
+                            ('[.start:.stop]', items[4:6]), ('[.start::.step]', items[4::3])]:
+            fmt = '<root<item*.items%s&?>>' % window
+            obj = dict(items=items, start=4, stop='6', step=3)
+            for backend in ('ast', 'codegen'):
+                self.assertEqual(xmlser.serialize(fmt, obj, backend=backend),
+                                 xmlser.serialize('<root<item*?&?>>', exp))
+
+    def test_lazy(self):
+        def source():
+            for i in range(10):
+                pulled.append(i)
+                yield i
+        for backend in ('ast', 'codegen'):
+            pulled = []
+            self.assertEqual(xmlser.serialize('<root<item*.items[1:3]&?>>', dict(items=source()), backend=backend),
+                             '<root><item>1</item><item>2</item></root>')
+            self.assertEqual(pulled, [0, 1, 2])
+
+    def test_fixed_count(self):
+        self.assertEqual(xmlser.serialize('<root<i*5[3:]&?>>', None), '<root><i>3</i><i>4</i></root>')
+        self.assertEqual(xmlser.serialize('<root<i*5[3:]>>', None), '<root><i></i><i></i></root>')
+
+    def test_invalid(self):
+        for fmt in ['<root<i*?[1]>>', '<root<i*?[1:2:3:4]>>', '<root<i*?[a:b]>>', '<root<i*?[1:2>>']:
+            self.assertRaises(xmlser.exc.SerializationFormatError, xmlser.serialize, fmt, [])
+
+class IterSerializeTests(unittest.TestCase):
+
+    def test_chunks(self):
+        items = ['item%d' % i for i in range(100)]
+        chunks = list(xmlser.iter_serialize('<root<sub*?&?>>', items, chunk_size=64))
+        self.assertTrue(len(chunks) > 1)
+        self.assertTrue(all(isinstance(c, str) for c in chunks))
+        self.assertEqual(''.join(chunks), xmlser.serialize('<root<sub*?&?>>', items, encoding='utf-8', direct=True))
+
+    def test_lazy(self):
+        pulled = []
+        def source():
+            for i in range(1000):
+                pulled.append(i)
+                yield i
+        chunks = xmlser.make_serializer('<root<sub*?&?>>').iter(source(), chunk_size=32)
+        first = next(chunks)
+        self.assertTrue(len(first) >= 32)
+        self.assertTrue(len(pulled) < 10)
+        rest = ''.join(chunks)
+        self.assertEqual(len(pulled), 1000)
+        self.assertTrue(rest.endswith('<sub>999</sub></root>'))
+
+    def test_encoding(self):
+        chunks = xmlser.iter_serialize(u'<root&\xe4>', None, encoding='latin1', declaration=True)
+        self.assertEqual(''.join(chunks), '<?xml version="1.0" encoding="latin1"?><root>\xe4</root>')
+
 if __name__ == "__main__":
     unittest.main()